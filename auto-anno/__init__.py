@@ -1 +1,10 @@
 from .lib import *
+
+
+def __getattr__(name):
+    # the collector is only imported when its API is used, so that running
+    # `python -m auto-anno.log` does not import it before its own module
+    if name in ("start", "stop", "dump", "handle_signals"):
+        from . import api
+        return getattr(api, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
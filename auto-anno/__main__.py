@@ -3,116 +3,231 @@ import os
 import re
 import sys
 import ast
-import runpy
+import shlex
 import shutil
 import argparse
-
-# third party
-import cloudpickle
+import multiprocessing
 
 # local
 from .lib import *
+from . import lib, collect, log
 
 
 # ** read system arguments and set up global variables **
 
 parser = argparse.ArgumentParser()
-parser.add_argument("script", help="the script to run")
-parser.add_argument("-n", type=int, default=1, help="number of times to run the script")
+parser.add_argument(
+    "scripts",
+    nargs="*",
+    metavar="script",
+    help="the scripts to run, each optionally followed by its arguments in "
+    "the same quoted string, e.g. 'train.py --epochs 2'; without scripts, "
+    "the files are only annotated from the log",
+)
+parser.add_argument("-n", type=int, default=1, help="number of times to run each script")
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="run the scripts in this many worker processes, each starting from "
+    "a clean state and collecting its own records, and annotate the files in "
+    "this many processes",
+)
 parser.add_argument("-v", "--verbose", action="store_true")
 parser.add_argument(
     "-i", action="store_true", help="prompt before overwriting each script"
 )
 parser.add_argument(
-    "--log", default="type_records.pkl", help="output file for type records"
+    "--log",
+    default="type_records.log",
+    help="the directory of the log of type records, which new records are "
+    "appended to",
+)
+parser.add_argument(
+    "--flush",
+    type=float,
+    default=10,
+    metavar="SECONDS",
+    help="append the new records to the log every SECONDS while collecting "
+    "(0 to only append them at the end)",
 )
 parser.add_argument("--cwd", default=None, help="working directory")
+parser.add_argument(
+    "--backend",
+    choices=("auto",) + collect.BACKENDS,
+    default="auto",
+    help="how to collect the types: sys.monitoring (Python 3.12+) or "
+    "sys.setprofile; 'auto' uses sys.monitoring if it is available",
+)
 parser.add_argument(
     "--backup", action="store_true", help="backup the scripts before annotating them"
 )
+parser.add_argument(
+    "--sample",
+    type=int,
+    default=None,
+    metavar="SIZE",
+    help="only inspect SIZE elements of each collection to infer its type",
+)
+parser.add_argument(
+    "--sample-depth",
+    type=int,
+    default=4,
+    help="do not inspect the elements of collections nested deeper than this "
+    "(only with --sample)",
+)
+parser.add_argument(
+    "--sample-mode",
+    choices=Sampling.MODES,
+    default="head",
+    help="which elements of a collection are inspected (only with --sample)",
+)
+parser.add_argument(
+    "--recheck",
+    type=int,
+    default=None,
+    metavar="N",
+    help="reuse the types inferred for calls whose arguments have the same "
+    "classes and collection sizes, and only infer them again every N calls",
+)
+parser.add_argument(
+    "--converge",
+    type=int,
+    default=None,
+    metavar="N",
+    help="stop tracing a function after N calls that add no new types to it",
+)
+parser.add_argument(
+    "--resample",
+    type=float,
+    default=None,
+    metavar="SECONDS",
+    help="trace a call of each converged function every SECONDS, and resume "
+    "tracing it if its types have changed (only with --converge)",
+)
+parser.add_argument(
+    "--children",
+    action="store_true",
+    help="also collect the types in the child processes of the script "
+    "(multiprocessing, concurrent.futures, subprocess Python workers)",
+)
+parser.add_argument(
+    "--probe-iterators",
+    action="store_true",
+    help="infer the element types of the map, filter, zip, enumerate and "
+    "reversed arguments as the functions consume them, by passing them a "
+    "proxy instead (other iterators are typed as a bare Iterator)",
+)
+parser.add_argument(
+    "--stats",
+    action="store_true",
+    help="count the events and time the type inference of each function, and "
+    "write a report of them to the log directory",
+)
+parser.add_argument(
+    "--format",
+    choices=("file", "signatures", "stubs"),
+    default="file",
+    help="format the annotated files with isort and black, or only format "
+    "the new signatures with black and only add the imports they use, or "
+    "leave the files unchanged and write their signatures to .pyi stubs",
+)
+parser.add_argument(
+    "--array-shapes",
+    action="store_true",
+    help="include the number of dimensions in the types of numpy arrays",
+)
 
 ARGS = parser.parse_args()
-DIR = os.path.dirname(os.path.abspath(ARGS.script))
-CWD = ARGS.cwd or DIR
-
-try:
-    TYPE_RECS = cloudpickle.load(open(ARGS.log, "rb"))
-    FIRST_RUN = False
-except:
-    TYPE_RECS = {}  # {filename: {(lineno, funcname): {argname: [type]}}}}
-    FIRST_RUN = True
-
-sys.path.extend([DIR, CWD])
-
-
-# ** run the script n times to collect type records **
-
-def profiler(frame, event, arg):
-    if event in ("call", "return"):
-        filename = os.path.abspath(frame.f_code.co_filename)
-        funcname = frame.f_code.co_name
-        
-        if filename.endswith(".py") and funcname[0] != "<" and CWD in filename:
-            recs = get_record(TYPE_RECS, filename)
-            
-            if "globals" not in recs:
-                recs["globals", None] = {
-                    id(v): k for k, v in frame.f_globals.items() if k[0] != "_"
-                }
-                
-            if event == "call":
-                # print(filename, funcname, frame.f_lineno, frame.f_locals)
-                arg_types = {var: get_type(val) for var, val in frame.f_locals.items()}
-                lineno = frame.f_lineno
-            else:
-                arg_types = {"return": get_type(arg)}
-                #! assumes no nested function has the same name as the outer function
-                lineno = max(ln for ln, fn in recs
-                             if fn == funcname and ln <= frame.f_lineno)
-
-            rec = get_record(recs, (lineno, funcname))
-            for k, t in arg_types.items():
-                arg_mod = type(arg).__module__
-                cur_mod = frame.f_globals['__name__']
-                if arg_mod in cur_mod:
-                    t = t.__name__  # forward reference (PEP 484)
-                get_record(rec, k, []).append(t)
-
-    return profiler
-
-def get_record(recs, key, default=None):
-    if default is None:
-        default = {}
-    if FIRST_RUN:
-        return recs.setdefault(key, default)
-    else:
-        try:
-            return recs[key]
-        except KeyError:
-            os.remove(ARGS.log)
-            raise SystemExit("Files have been modified since the last run. "
-                             "Removed previous log file.")
-
-
-sys.setprofile(profiler)
-
-for _ in range(ARGS.n):
-    runpy.run_path(sys.argv[1], run_name="__main__")
-
-sys.setprofile(None)
-
-with open(ARGS.log, "wb") as f:
-    cloudpickle.dump(TYPE_RECS, f)
+if ARGS.backend == "monitoring" and not hasattr(sys, "monitoring"):
+    parser.error("the monitoring backend requires Python 3.12+")
+if ARGS.jobs > 1 and "fork" not in multiprocessing.get_all_start_methods():
+    parser.error("--jobs requires the fork start method")
+if ARGS.sample is not None and ARGS.sample < 1:
+    parser.error("--sample must be at least 1")
+if ARGS.sample_depth < 0:
+    parser.error("--sample-depth must not be negative")
+RUNS = [shlex.split(s) for _ in range(ARGS.n) for s in ARGS.scripts]
+DIRS = list(dict.fromkeys(os.path.dirname(os.path.abspath(r[0])) for r in RUNS))
+CWD = ARGS.cwd or (DIRS[0] if DIRS else os.getcwd())
+
+sys.path.extend(DIRS + [CWD])
+
+if os.path.isfile(ARGS.log):
+    parser.error(f"{ARGS.log} is not a log directory")
+TYPE_RECS = log.read_log(ARGS.log)  # {filename: {(qualname, hash): {argname: Counter({type: n})}}}
+# remove the records of the functions changed since the last run, also from the log
+if collect.prune_records(TYPE_RECS):
+    log.compact(ARGS.log, prune=collect.prune_records)
+
+
+# ** run the scripts n times to collect type records **
+
+collect.CWD = CWD
+collect.TYPE_RECS = TYPE_RECS
+collect.LOG = ARGS.log
+collect.FLUSH = ARGS.flush
+collect.RECHECK = ARGS.recheck
+collect.CONVERGE = ARGS.converge
+collect.RESAMPLE = ARGS.resample
+collect.PROBE = ARGS.probe_iterators
+lib.ARRAY_SHAPES = ARGS.array_shapes
+if ARGS.stats:
+    collect.STATS = {}
+if ARGS.sample is not None:
+    collect.SAMPLING = Sampling(ARGS.sample, ARGS.sample_depth, ARGS.sample_mode)
+
+if not RUNS:  # only annotate from the log
+    collect.index_modules()  # by the names that the annotated files import
+elif ARGS.jobs > 1:
+    # each run is collected in its own process, forked before any script has
+    # run, and the results are merged in the order of RUNS to be deterministic
+    for data in collect.run_jobs(
+        RUNS, ARGS.jobs, backend=ARGS.backend, children=ARGS.children
+    ):
+        collect.load_job(data)
+else:
+    if ARGS.children:
+        collect.trace_children(ARGS.backend)
+
+    collect.start(ARGS.backend)
+
+    script_globals = {}
+    for argv in RUNS:
+        script_globals[os.path.abspath(argv[0])] = collect.run_script(argv)
+
+    collect.stop()
+
+    if ARGS.children:
+        collect.merge_shards()
+        collect.index_modules(script_globals)
+
+if ARGS.verbose and RUNS:
+    print(
+        "Traced {traced} events ({cached} with cached types), "
+        "skipped {skipped} events.".format(**collect.EVENTS)
+    )
+
+if collect.CONVERGED:
+    print("Converged functions (number of calls when converged):")
+    for (path, (qualname, _)), calls in collect.CONVERGED.items():
+        print(f"  {path} {qualname}: {calls}")
+
+if ARGS.stats and RUNS:
+    print("Statistics written to {} and {}".format(*collect.write_stats_report(ARGS.log)))
 
 
 # ** write the type annotations to the script **
 
-for path, recs in TYPE_RECS.items():
-    s = annotate_script(path, recs, ARGS.verbose)
-    if s is None:
-        continue
-    if ARGS.backup:
+def write(path, s):
+    if ARGS.backup and os.path.exists(path):
         shutil.copy(path, path + ".bak")
-    if not ARGS.i or input(f"Overwrite {path}? ").lower() == "y":
-        with open(path, "w", encoding="utf8") as f:
-            f.write(s)
+    if ARGS.i and input(f"Overwrite {path}? ").lower() != "y":
+        return False
+    write_script(path, s)
+
+
+ANNOTATED = log.read_annotated(ARGS.log)  # {written path: [source hash, record keys]}
+annotate_files(TYPE_RECS, ANNOTATED, ARGS.format, ARGS.verbose, ARGS.jobs, write)
+log.write_annotated(ARGS.log, ANNOTATED)
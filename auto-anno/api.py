@@ -0,0 +1,97 @@
+""" Collect type records in a running process, e.g. a service that does not exit.
+
+    import importlib
+    anno = importlib.import_module("auto-anno")
+
+    anno.start(duration=60, rate=0.1)  # record 1 in 10 calls for a minute
+    ...
+    anno.dump()  # append the new records to the log now
+
+or let `kill -USR1 <pid>` start a window and `kill -USR2 <pid>` end it:
+
+    anno.handle_signals(duration=600, rate=0.1)
+
+The records are appended to the log every `flush` seconds and when collection
+stops, and the functions are annotated from the log later by running
+`python -m auto-anno --log LOG` without scripts. While collection is off, no
+hook is installed, so the process runs at its normal speed (see
+`bench.bench_attach`).
+"""
+
+# stdlib
+import os
+import signal
+import threading
+
+# local
+from . import collect, log
+
+
+_timer = None  # the threading.Timer that ends the window
+_dumps = {}  # {log path: the log.Shard of the records dumped to it}
+
+
+def start(cwd=None, log_dir="type_records.log", duration=None, rate=None,
+          flush=10.0, sampling=None, backend="auto"):
+    """ Start collecting the types of the functions defined under `cwd` (the
+    current directory by default) into the log `log_dir`, or only in memory if
+    it is None. Collection stops after `duration` seconds if it is given, and
+    only a fraction `rate` of the calls is recorded if it is given. Does
+    nothing if it is already collecting. """
+    global _timer
+    if collect.collecting():
+        return
+    cwd = os.path.abspath(cwd or os.getcwd())
+    if cwd != collect.CWD:
+        collect.CWD = cwd
+        collect.CODES.clear()  # their filter decisions depend on CWD
+    collect.LOG = log_dir and os.path.abspath(log_dir)
+    collect.FLUSH = flush
+    collect.RATE = rate
+    collect.SAMPLING = sampling
+    collect.start(backend)
+    if duration is not None:
+        _timer = threading.Timer(duration, stop)
+        _timer.daemon = True
+        _timer.start()
+
+
+def stop():
+    """ Stop collecting and append the new records to the log. """
+    global _timer
+    if _timer is not None:
+        if _timer is not threading.current_thread():
+            _timer.cancel()
+        _timer = None
+    collect.stop()
+
+
+def dump(path=None):
+    """ Append the new records to the log, or to the log `path`, which gets
+    the counts that the records have gained since the last dump to it (all of
+    them at the first dump). """
+    if path is None or os.path.abspath(path) == collect.LOG:
+        collect.write_log()
+        return
+    records = {}
+    collect.merge_records(records, collect.TYPE_RECS)
+    for buffer in list(collect.BUFFERS):  # of the threads, until stop merges them
+        if not buffer.main:
+            collect.merge_records(records, buffer.records)
+    path = os.path.abspath(path)
+    os.makedirs(path, exist_ok=True)
+    try:
+        shard = _dumps[path]
+    except KeyError:
+        shard = _dumps[path] = log.Shard(path)
+    shard.write(records)
+    shard.close()
+
+
+def handle_signals(duration=None, start_signal=signal.SIGUSR1,
+                   stop_signal=signal.SIGUSR2, **kwargs):
+    """ Start collecting on `start_signal` (for `duration` seconds if given),
+    and stop on `stop_signal`. `kwargs` are passed to `start`. Must be called
+    from the main thread. """
+    signal.signal(start_signal, lambda signum, frame: start(duration=duration, **kwargs))
+    signal.signal(stop_signal, lambda signum, frame: stop())
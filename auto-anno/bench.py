@@ -0,0 +1,396 @@
+""" Benchmarks of auto-anno: the cost of collection on synthetic workloads,
+and micro-benchmarks of the type lattice and of the attached collector.
+
+For each workload, the suite reports the wall-time overhead of collection
+against an untraced run, the events seen per second, the objects typed by
+get_type per second, and the memory of the records (traced by tracemalloc).
+The results can be saved as JSON and compared with the ones of another
+version:
+
+    python -m auto-anno.bench --json new.json --compare old.json [WORKLOAD ...]
+"""
+
+# stdlib
+import gc
+import os
+import sys
+import json
+import shutil
+import inspect
+import argparse
+import platform
+import tempfile
+import importlib
+import tracemalloc
+from time import perf_counter
+from timeit import Timer
+from itertools import product
+
+# local
+from .lib import *
+from . import api, collect
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# the other modules of the package, which are not traced with the workloads
+EXCLUDE = {os.path.join(HERE, f) for f in os.listdir(HERE)
+           if f.endswith(".py") and f != "bench.py"}
+
+
+# ** type lattice: memoized joins vs enumeration of supertypes **
+
+def enumerate_suptypes(t, type_map=None):
+    """ The supertypes of a type, enumerated without memoization. """
+    if hasattr(t, "__origin__"):
+        T = t.__origin__
+        sts = [T[ts] for ts in
+               product(*[enumerate_suptypes(a, type_map) for a in t.__args__])
+               if not TypeLattice.excluded(T, ts)]
+        sts += enumerate_suptypes(T, type_map)
+    elif inspect.isclass(t):
+        sts = list(t.__mro__) if issubclass(t, type) else list(t.mro())
+    elif t in (Ellipsis, None, Any):
+        sts = [t]
+    elif t in (Optional, Union):
+        sts = [object]
+    else:  # used type name as annotation
+        sts = [t, object]
+    if type_map:
+        sts = [type_map.get(t, t) for t in sts]
+    return sts
+
+
+def enumerate_common_suptype(ts, type_map=None):
+    """ The first common supertype in the enumerated supertypes of `ts`. """
+    ts = set(ts)
+    optional = None in ts
+    ts.discard(None)
+    if not ts:
+        return None
+    sts = [enumerate_suptypes(t, type_map) for t in ts]
+    for t in min(sts, key=len):
+        if all(t in s for s in sts):
+            break
+    else:
+        return Any
+    return Optional[t] if optional else t
+
+
+def nested_type(depth, leaf):
+    """ dict[tuple[leaf, Real], list[str]], nested `depth` times. """
+    t = leaf
+    for _ in range(depth):
+        t = dict[tuple[t, Real], list[str]]
+    return t
+
+
+def time_per_call(f, min_time=0.2):
+    number, t = Timer(f).autorange()
+    while t < min_time:
+        number *= 2
+        t = Timer(f).timeit(number)
+    return t / number
+
+
+def bench_lattice(max_depth=3) -> dict:
+    results = {}
+    print(f"{'depth':>5} {'enumerate':>12} {'join (cold)':>12} "
+          f"{'join (warm)':>12} {'speedup':>8}")
+    for depth in range(1, max_depth + 1):
+        ts = [nested_type(depth, Integral), nested_type(depth, Real)]
+        expected = enumerate_common_suptype(ts, TYPE_MAP)
+        assert get_common_suptype(ts, TYPE_MAP) == expected
+        t_enum = time_per_call(lambda: enumerate_common_suptype(ts, TYPE_MAP))
+        t_cold = time_per_call(
+            lambda: TypeLattice(TYPE_MAP).join(frozenset(ts)))
+        t_warm = time_per_call(lambda: get_common_suptype(ts, TYPE_MAP))
+        print(f"{depth:>5} {t_enum * 1e6:>10.1f}us {t_cold * 1e6:>10.1f}us "
+              f"{t_warm * 1e6:>10.1f}us {t_enum / t_cold:>7.0f}x")
+        results[depth] = {"enumerate_s": t_enum, "join_cold_s": t_cold,
+                          "join_warm_s": t_warm}
+    return results
+
+
+# ** attached collector: overhead while collection is off and on **
+
+def workload(n=200):
+    """ Calls of a small function with a few arguments of varied types. """
+    def step(i, xs, name):
+        return len(xs) + i if name else i
+    return sum(step(i, [i] * 3, "x") for i in range(n))
+
+
+def bench_attach(rates=(None, 0.1, 0.01)) -> dict:
+    here = HERE
+    t_base = min(time_per_call(workload) for _ in range(5))
+    api.start(cwd=here, log_dir=None)
+    api.stop()
+    t_off = min(time_per_call(workload) for _ in range(5))
+    print(f"{'collection':>16} {'time':>10} {'overhead':>9}")
+    print(f"{'never started':>16} {t_base * 1e6:>8.1f}us {'':>9}")
+    print(f"{'off (stopped)':>16} {t_off * 1e6:>8.1f}us {t_off / t_base - 1:>8.0%}")
+    results = {"baseline_s": t_base, "off_s": t_off}
+    for rate in rates:
+        api.start(cwd=here, log_dir=None, rate=rate)
+        try:
+            t_on = time_per_call(workload)
+        finally:
+            api.stop()
+        label = f"on (rate {rate or 1:g})"
+        print(f"{label:>16} {t_on * 1e6:>8.1f}us {t_on / t_base - 1:>8.0%}")
+        results[f"rate_{rate or 1:g}_s"] = t_on
+    return results
+
+
+# ** synthetic workloads: overhead, throughput and memory of collection **
+
+class Workload:
+    """ A workload whose functions are traced: `run` is timed with and without
+    collection, and `values` are typical arguments, whose types are inferred
+    to measure get_type alone. """
+
+    def __init__(self, run, values, cwd=HERE, close=None):
+        self.run = run
+        self.values = values
+        self.cwd = cwd  # the directory of the traced functions
+        self.close = close
+
+
+WORKLOADS = {}  # {name: function that sets up the Workload}
+
+
+def register_workload(setup):
+    WORKLOADS[setup.__name__.removeprefix("setup_")] = setup
+    return setup
+
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+
+@register_workload
+def setup_recursion():
+    """ Many calls of a recursive function with small arguments. """
+    return Workload(lambda: fib(20), list(range(20)))
+
+
+def wide(a, b, c, d, e, f, g, h, i, j, k=None, l=0.0, m="", n=b"", o=(), p=None):
+    return a
+
+
+@register_workload
+def setup_wide_args():
+    """ Calls with many arguments of different types. """
+    args = (1, 2.0, "s", b"b", None, True, (1, "x"), [1, 2], {"k": 1}, {1, 2},
+            frozenset(), 3j, range(3), bytearray(b"x"), slice(1), 1.5)
+    return Workload(lambda: [wide(*args) for _ in range(3000)], list(args))
+
+
+def total(data):
+    return sum(len(v) for v in data.values())
+
+
+@register_workload
+def setup_nested():
+    """ Calls with large nested containers. """
+    data = {f"k{i}": [(j, j / 2, str(j)) for j in range(10)] for i in range(200)}
+    rows = [list(range(50)) for _ in range(50)]
+    return Workload(lambda: [total(data) + len(rows) for _ in range(20)], [data, rows])
+
+
+def normalize(a):
+    return (a - a.mean()) / (a.std() + 1e-9)
+
+
+def dot(a, b):
+    return float(a @ b)
+
+
+@register_workload
+def setup_arrays():
+    """ Numeric code that passes numpy arrays around. """
+    import numpy as np  # optional
+    rng = np.random.default_rng(0)
+    a, b = rng.random(1000), rng.random(1000)
+    return Workload(lambda: [dot(normalize(a), b) for _ in range(2000)],
+                    [a, rng.random((100, 8)), a.astype(np.float32), a > 0.5])
+
+
+MODULE = """
+class Item:
+    def __init__(self, name, size):
+        self.name, self.size = name, size
+
+def make(i):
+    return Item(str(i), i * 1.5)
+
+def sizes(items):
+    return [x.size for x in items]
+
+def index(items):
+    return {x.name: x for x in items}
+
+def main():
+    items = [make(i) for i in range(10)]
+    return sum(sizes(items)) + len(index(items))
+"""
+
+
+@register_workload
+def setup_modules(n=100):
+    """ A project of many small modules with their own classes. """
+    tmp = tempfile.mkdtemp(prefix="anno-bench-")
+    for i in range(n):
+        with open(os.path.join(tmp, f"anno_bench_{i}.py"), "w") as f:
+            f.write(MODULE)
+    sys.path.insert(0, tmp)
+    mods = [importlib.import_module(f"anno_bench_{i}") for i in range(n)]
+
+    def close():
+        sys.path.remove(tmp)
+        for i in range(n):
+            del sys.modules[f"anno_bench_{i}"]
+        shutil.rmtree(tmp)
+
+    items = [m.make(1) for m in mods[:10]]
+    return Workload(lambda: [m.main() for m in mods for _ in range(5)],
+                    [items, {x.name: x for x in items}], cwd=tmp, close=close)
+
+
+def count_objects(x) -> int:
+    """ The number of objects in `x`, counting the elements of collections. """
+    if isinstance(x, dict):
+        return 1 + sum(count_objects(k) + count_objects(v) for k, v in x.items())
+    if isinstance(x, (list, tuple, set, frozenset)):
+        return 1 + sum(map(count_objects, x))
+    return 1
+
+
+def timed(f) -> float:
+    gc.collect()
+    t = perf_counter()
+    f()
+    return perf_counter() - t
+
+
+def traced(w: Workload, backend) -> float:
+    """ The time of a run of `w` while collecting, from empty records. """
+    collect.reset()
+    collect.start(backend)
+    try:
+        return timed(w.run)
+    finally:
+        collect.stop()
+
+
+def memory(f) -> tuple:
+    """ The memory (current, peak) allocated by `f` and still alive after it. """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        f()
+        gc.collect()
+        return tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+
+def bench_workload(w: Workload, backend="auto", repeat=3) -> dict:
+    collect.CWD, collect.EXCLUDE = w.cwd, EXCLUDE
+    w.run()  # warm up
+    t_base = min(timed(w.run) for _ in range(repeat))
+    t_traced = min(traced(w, backend) for _ in range(repeat))
+    events = sum(collect.EVENTS[k] for k in ("traced", "skipped", "unsampled"))
+    t_infer = time_per_call(lambda: [get_type(v) for v in w.values])
+    _, base_peak = memory(w.run)
+    records, peak = memory(lambda: traced(w, backend))
+    collect.reset()
+    return {
+        "baseline_s": t_base,
+        "traced_s": t_traced,
+        "overhead": t_traced / t_base - 1,
+        "events": events,
+        "events_per_s": events / t_traced,
+        "objects_per_s": sum(map(count_objects, w.values)) / t_infer,  # by get_type
+        "records_kb": records / 1024,  # kept after collection stops
+        "peak_kb": (peak - base_peak) / 1024,  # more than the untraced run
+    }
+
+
+def bench_workloads(names, backend="auto", repeat=3) -> dict:
+    results = {}
+    print(f"{'workload':>10} {'baseline':>10} {'traced':>10} {'overhead':>9} "
+          f"{'events/s':>10} {'objects/s':>11} {'records':>10} {'peak':>10}")
+    for name in names:
+        try:
+            w = WORKLOADS[name]()
+        except ImportError as e:
+            print(f"{name:>10} skipped: {e}")
+            continue
+        try:
+            r = results[name] = bench_workload(w, backend, repeat)
+        finally:
+            if w.close is not None:
+                w.close()
+        print(f"{name:>10} {r['baseline_s'] * 1e3:>8.1f}ms {r['traced_s'] * 1e3:>8.1f}ms "
+              f"{r['overhead']:>8.0%} {r['events_per_s']:>10.3g} "
+              f"{r['objects_per_s']:>11.3g} {r['records_kb']:>8.0f}kB "
+              f"{r['peak_kb']:>8.0f}kB")
+    return results
+
+
+def compare(results: dict, base: dict):
+    """ Print the ratios of the metrics of the workloads to the ones of
+    `base`, e.g. the results of the previous version. """
+    print(f"{'workload':>10} {'metric':>15} {'base':>10} {'new':>10} {'ratio':>7}")
+    for name, r in results["workloads"].items():
+        for metric, new in r.items():
+            old = base.get("workloads", {}).get(name, {}).get(metric)
+            if old:
+                print(f"{name:>10} {metric:>15} {old:>10.4g} {new:>10.4g} "
+                      f"{new / old:>6.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m auto-anno.bench")
+    parser.add_argument("workloads", nargs="*", metavar="workload",
+                        help=f"the workloads to run: {', '.join(WORKLOADS)} "
+                        "(all by default)")
+    parser.add_argument("--backend", choices=("auto",) + collect.BACKENDS,
+                        default="auto")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="take the best time of this many runs")
+    parser.add_argument("--micro", action="store_true",
+                        help="also run the benchmarks of the type lattice and "
+                        "of the attached collector")
+    parser.add_argument("--json", metavar="PATH", help="save the results to PATH")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="compare the results with the ones saved in PATH")
+    args = parser.parse_args(argv)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload: {name}")
+
+    backend = args.backend
+    if backend == "auto":
+        backend = "monitoring" if hasattr(sys, "monitoring") else "setprofile"
+    results = {"python": platform.python_version(), "backend": backend}
+    results["workloads"] = bench_workloads(args.workloads or list(WORKLOADS),
+                                           backend, args.repeat)
+    if args.micro:
+        print()
+        results["lattice"] = bench_lattice()
+        print()
+        results["attach"] = bench_attach()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        print()
+        compare(results, base)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1216 @@
+""" Collect the runtime types of the arguments and return values of functions.
+
+Two backends are available:
+- "setprofile": a `sys.setprofile` hook, which sees every call and return event
+  of the process (including C calls) and filters them afterwards.
+- "monitoring": PEP 669 `sys.monitoring` (Python 3.12+), which only receives
+  PY_START and PY_RETURN events and disables them for every code object that
+  is not traced, so untraced code runs at full speed after its first call.
+  A frame that exits by an exception records no return.
+
+Child processes are traced too if `trace_children` is called: forked ones
+inherit the running collector, and spawned Python processes start one from a
+sitecustomize module. Each child writes its records to the log SHARDS, and
+`merge_shards` adds them to the records of the parent and moves them to LOG.
+
+Separate runs of scripts can be collected in worker processes by `run_job`,
+whose results are merged in order by `load_job`.
+
+Both backends trace all threads (with sys.setprofile before Python 3.12, only
+the ones started after collection starts). The main thread records into TYPE_RECS and
+every other thread into its own Buffer, without locks; the buffers are merged
+into TYPE_RECS by `flush`, which runs when collection stops.
+
+The new counts of the records of each thread are appended to its own shard of
+the log LOG every FLUSH seconds and when collection stops (see `log`).
+"""
+
+# stdlib
+import os
+import sys
+import ast
+import json
+import shlex
+import runpy
+import inspect
+import atexit
+import ctypes
+import random
+import signal
+import shutil
+import tempfile
+import threading
+import importlib
+import traceback
+from time import perf_counter
+from itertools import islice
+from collections import Counter
+
+# third party
+import cloudpickle
+
+# local
+from . import lib, log
+from .lib import *
+
+
+CWD = os.getcwd()  # only the functions defined under CWD are traced
+EXCLUDE = set()  # the files under CWD whose functions are not traced, e.g. tests
+TYPE_RECS = {}  # {filename: {(qualname, hash): {argname: Counter({type: n})}}}
+LOG = None  # the log directory of the records
+FLUSH = None  # write the new records to LOG every FLUSH seconds
+RATE = None  # only record this fraction of the traced calls, chosen at random
+SAMPLING = None  # the Sampling of large collections by get_type
+RECHECK = None  # re-infer the types of a known fingerprint every RECHECK calls
+CONVERGE = None  # stop tracing a function after CONVERGE calls without new types
+RESAMPLE = None  # trace a call of each converged function every RESAMPLE seconds
+PROBE = False  # wrap the plain iterator arguments in IteratorProbes to infer their types
+PROBE_SIZE = 10  # the number of elements of an iterator argument whose types are inferred
+CONVERGED = {}  # {(filename, (qualname, hash)): number of calls when converged}
+STATS = None  # {(filename, key): [events, {argname: seconds in get_type}]} if enabled
+SHARDS = None  # the directory where the child processes write their records
+GLOBALS = {}  # {filename: GlobalsIndex}
+DEFS = {}  # {filename: get_def_keys of its source}
+CODES = {}  # {id(code): CodeInfo}
+BUFFERS = []  # the Buffers of the threads
+# number of events seen by the backend, of traced events whose types were
+# taken from the fingerprint cache, and of traced events left out by RATE
+EVENTS = {"traced": 0, "skipped": 0, "cached": 0, "unsampled": 0}
+
+BACKENDS = ("monitoring", "setprofile")
+TOOL_IDS = (2, 3, 4)  # the sys.monitoring tool ids to use: PROFILER_ID, or unassigned ones
+CHILD_ENV = "AUTO_ANNO_CHILD"  # the config of the collectors of child processes
+STATS_SUFFIX = ".stats"  # of the files of the STATS of the child processes in SHARDS
+
+_backend = None  # the running backend
+_tool_id = None  # the sys.monitoring tool id of the monitoring backend
+_local = threading.local()  # .buffer: the Buffer of the thread
+_resampler = None  # the thread that resamples the converged functions
+_flusher = None  # the thread that writes the records to LOG periodically
+_probes = {}  # {id(frame): [(IteratorProbe, record, argname)]} until the frame returns
+_unsampled = set()  # the ids of the frames whose calls were left out by RATE
+_shards = {}  # {id of the Buffer of a thread, or None for TYPE_RECS: log.Shard}
+_dumped = False  # whether the records of this child process have been dumped
+_dumping = False  # whether dump_shard is writing them
+_terminated = False  # whether a SIGTERM came while dumping them
+_pythonpath = None  # the PYTHONPATH before `trace_children`
+
+
+def is_traced(filename, funcname) -> bool:
+    """ Whether the calls of a function should be recorded. """
+    return (filename.endswith(".py") and funcname[0] != "<" and CWD in filename
+            and filename not in EXCLUDE)
+
+
+class CodeInfo:
+    """ The cached filter decision of a code object, so that an event only
+    costs a dict lookup once its code object has been seen. """
+
+    __slots__ = ("code", "traced", "filename", "key", "recs", "rec", "args",
+                 "shapes", "calls", "streak", "seen", "joins", "stats")
+
+    def __init__(self, code):
+        self.code = code  # keeps the code alive so that its id is not reused
+        self.filename = os.path.abspath(code.co_filename)
+        self.key = (get_def_key(self.filename, code)
+                    if is_traced(self.filename, code.co_name) else None)
+        self.traced = self.key is not None
+        if self.traced:
+            self.recs = TYPE_RECS.setdefault(self.filename, {})  # of the file
+            self.rec = self.recs.setdefault(self.key, {})  # of the function
+            self.args = get_probed_args(code)
+            self.shapes = {}  # {(event, fingerprint): [hits, types]}
+            self.calls = 0
+            self.streak = 0  # number of the last calls without new types
+            self.seen = {}  # {argname: the types seen in all threads}
+            self.joins = {}  # {argname: the common supertype of its types}
+            self.stats = None if STATS is None else STATS.setdefault(
+                (self.filename, self.key), [0, {}])
+        else:
+            self.recs = self.rec = self.stats = None
+
+
+class Buffer:
+    """ The records of a thread, which only that thread writes to. """
+
+    def __init__(self, records=None):
+        self.thread = threading.current_thread()
+        self.main = records is not None  # records into TYPE_RECS
+        self.records = {} if records is None else records
+        self.recs = {}  # {id(code): the record of the function}
+
+    def get(self, info: CodeInfo) -> dict:
+        """ Get the record of the function of a traced code object. """
+        try:
+            return self.recs[id(info.code)]
+        except KeyError:
+            pass
+        if self.main:
+            rec = info.rec
+        else:
+            recs = self.records.setdefault(info.filename, {})
+            rec = recs.setdefault(info.key, {})
+        self.recs[id(info.code)] = rec
+        return rec
+
+    def swap(self) -> dict:
+        """ Take the records of the buffer and leave it empty. """
+        records = self.records
+        self.records, self.recs = {}, {}
+        return records
+
+
+def get_buffer() -> Buffer:
+    try:
+        return _local.buffer
+    except AttributeError:
+        if threading.current_thread() is threading.main_thread():
+            buffer = Buffer(TYPE_RECS)
+        else:
+            buffer = Buffer()
+        BUFFERS.append(buffer)
+        _local.buffer = buffer
+        return buffer
+
+
+def merge_records(dst: dict, src: dict):
+    """ Add the type counts of the records `src` to the records `dst`.
+
+    >>> dst = {"a.py": {("f", "h"): {"x": Counter({int: 1})}}}
+    >>> merge_records(dst, {"a.py": {("f", "h"): {"x": Counter({int: 2, str: 1})}},
+    ...                     "b.py": {("g", "k"): {"return": Counter({str: 1})}}})
+    >>> dst["a.py"]
+    {('f', 'h'): {'x': Counter({<class 'int'>: 3, <class 'str'>: 1})}}
+    >>> dst["b.py"]
+    {('g', 'k'): {'return': Counter({<class 'str'>: 1})}}
+    """
+    for filename, recs in list(src.items()):
+        dst_recs = dst.setdefault(filename, {})
+        for key, rec in list(recs.items()):
+            if key == ("globals", None):
+                dst_recs.setdefault(key, rec)
+                continue
+            dst_rec = dst_recs.setdefault(key, {})
+            for k, counts in list(rec.items()):
+                dst_rec.setdefault(k, Counter()).update(counts)
+
+
+def flush():
+    """ Merge the records of the threads into TYPE_RECS. """
+    for buffer in list(BUFFERS):
+        if buffer.main:
+            continue
+        merge_records(TYPE_RECS, buffer.swap())
+        if not buffer.thread.is_alive():
+            BUFFERS.remove(buffer)
+
+
+def get_code_info(code) -> CodeInfo:
+    try:
+        return CODES[id(code)]
+    except KeyError:
+        info = CODES[id(code)] = CodeInfo(code)
+        return info
+
+
+class GlobalsIndex:
+    """ An index {id(value): name} of the public globals of a module, which is
+    shared with `get_full_name` at annotation time.
+
+    It is built once per module and then only extended when the number of
+    globals changes (e.g. after a lazy import), which costs a `len` per event.
+    Rebound names are picked up by `refresh`, which runs when collection stops.
+    """
+
+    def __init__(self, module_globals: dict):
+        self.names = {}
+        self.bind(module_globals)
+
+    def bind(self, module_globals: dict):
+        """ Index another globals dict of the module, e.g. when a script is
+        run again by runpy. """
+        self.module_globals = module_globals
+        self.refresh()
+
+    def refresh(self):
+        self.names.clear()
+        self.size = 0
+        self.update()
+
+    def update(self):
+        """ Index the names added to the globals since the last update.
+
+        >>> g = {"a": object(), "_b": object()}
+        >>> index = GlobalsIndex(g)
+        >>> list(index.names.values())
+        ['a']
+        >>> g["c"] = c = object()
+        >>> index.update()
+        >>> index.names[id(c)]
+        'c'
+        >>> del g["a"]
+        >>> g["d"] = object()  # as many globals as before: not updated
+        >>> index.update()
+        >>> sorted(index.names.values())
+        ['a', 'c']
+        >>> index.refresh()
+        >>> sorted(index.names.values())
+        ['c', 'd']
+        """
+        g = self.module_globals
+        if len(g) == self.size:
+            return
+        if len(g) < self.size:  # some names are deleted
+            return self.refresh()
+        # new names are appended to the dict in insertion order
+        for k, v in islice(g.items(), self.size, None):
+            if k[0] != "_":
+                self.names[id(v)] = k
+        self.size = len(g)
+
+
+def get_globals_index(filename, module_globals, recs) -> GlobalsIndex:
+    try:
+        index = GLOBALS[filename]
+    except KeyError:
+        index = GLOBALS[filename] = GlobalsIndex(module_globals)
+        recs["globals", None] = index.names
+        return index
+    if index.module_globals is not module_globals:
+        index.bind(module_globals)
+    else:
+        index.update()
+    return index
+
+
+def record(info, frame, event, arg):
+    """ Record the types of the arguments ("call") or the return value
+    ("return") of a traced frame. """
+    get_globals_index(info.filename, frame.f_globals, info.recs)
+
+    try:
+        buffer = _local.buffer
+    except AttributeError:
+        buffer = get_buffer()
+    rec = buffer.get(info)
+    stats = info.stats
+    if stats is not None:
+        stats[0] += 1
+
+    if event == "call":
+        # print(info.filename, info.key, frame.f_locals)
+        values = frame.f_locals
+        probed = probe_iterators(info, frame, values, rec)
+        if probed:
+            values = {k: v for k, v in values.items() if k not in probed}
+    else:
+        values = {"return": arg}
+        if _probes:
+            report_probes(_probes.pop(id(frame), ()))
+
+    if RECHECK:  # skip the inference if the values have a known fingerprint
+        key = (event, get_fingerprint(values.values()))
+        try:
+            shape = info.shapes[key]
+        except KeyError:
+            shape = info.shapes[key] = [0, None]  # [hits, types]
+        shape[0] += 1
+        if shape[1] is not None and shape[0] % RECHECK:
+            EVENTS["cached"] += 1
+            add_types(rec, shape[1])
+            if CONVERGE:
+                check_convergence(info, event, shape[1])
+            return
+
+    types = {}
+    infer = TypeInference(SAMPLING)
+    for k, v in values.items():
+        if stats is None:
+            t = infer(v)
+        else:
+            t0 = perf_counter()
+            t = infer(v)
+            stats[1][k] = stats[1].get(k, 0.0) + perf_counter() - t0
+        arg_mod = type(arg).__module__
+        cur_mod = frame.f_globals['__name__']
+        if arg_mod in cur_mod:
+            t = t.__name__  # forward reference (PEP 484)
+        types[k] = t
+        if infer.sampled:  # {argname: number of sampled values}
+            rec.setdefault(("sampled", None), Counter())[k] += 1
+            infer.sampled = False
+    if RECHECK:
+        shape[1] = types
+    add_types(rec, types)
+    if CONVERGE:
+        check_convergence(info, event, types)
+
+
+GENERATOR_FLAGS = (inspect.CO_GENERATOR | inspect.CO_COROUTINE
+                   | inspect.CO_ASYNC_GENERATOR | inspect.CO_ITERABLE_COROUTINE)
+
+
+def get_probed_args(code) -> tuple:
+    """ The names of the arguments of a code object whose iterators can be
+    probed. The frames of generators and coroutines are not probed, since
+    their events do not tell when they finish. """
+    if not PROBE or code.co_flags & GENERATOR_FLAGS:
+        return ()
+    n = code.co_argcount + code.co_kwonlyargcount
+    return code.co_varnames[:n]  # *args and **kwargs are never iterators
+
+
+def probe_iterators(info, frame, values, rec) -> list:
+    """ Replace the plain iterators (see `is_probed`) in the arguments of a
+    frame by IteratorProbes, whose types are recorded when the frame returns.
+    The other iterators get the bare type Iterator. Returns their names. """
+    probed = []
+    for k in info.args:
+        v = values[k]
+        probe = type(v) is IteratorProbe  # probed by a caller
+        if not probe and is_probed(v):
+            v = IteratorProbe(v, PROBE_SIZE, SAMPLING)
+            set_local(frame, k, v)
+            probe = True
+        if probe:
+            _probes.setdefault(id(frame), []).append((v, rec, k))
+            probed.append(k)
+    return probed
+
+
+def set_local(frame, name, value):
+    """ Set a local variable of a running frame. """
+    frame.f_locals[name] = value
+    if sys.version_info < (3, 13):  # f_locals is a snapshot of the variables
+        ctypes.pythonapi.PyFrame_LocalsToFast(ctypes.py_object(frame), ctypes.c_int(0))
+
+
+def report_probes(probes):
+    for probe, rec, k in probes:
+        add_types(rec, {k: probe.get_type()})
+
+
+def add_types(rec, types):
+    for k, t in types.items():
+        # only the distinct types are stored, so the memory does not grow
+        # with the number of calls
+        try:
+            counts = rec[k]
+        except KeyError:
+            counts = rec[k] = Counter()
+        counts[t] += 1
+
+
+def check_convergence(info, event, types):
+    """ Stop tracing a function once the joins of the types of its arguments
+    and return value have not changed for CONVERGE calls.
+
+    >>> from types import SimpleNamespace
+    >>> info = SimpleNamespace(seen={}, joins={}, calls=0, streak=0, traced=True,
+    ...                        filename="a.py", key=("f", "h"))
+    >>> check_convergence.__globals__["CONVERGE"] = 2
+    >>> for t in (int, bool, int, int):  # bool joins to int: no new type
+    ...     check_convergence(info, "call", {"x": t})
+    ...     print(info.streak, info.traced)
+    0 True
+    1 True
+    2 False
+    3 False
+    >>> CONVERGED.pop(("a.py", ("f", "h")))
+    4
+    >>> check_convergence.__globals__["CONVERGE"] = None
+    """
+    changed = False
+    for k, t in types.items():
+        try:
+            seen = info.seen[k]
+        except KeyError:
+            seen = info.seen[k] = set()
+        if t not in seen:
+            seen.add(t)
+            j = get_common_suptype(seen)
+            if info.joins.get(k, NOTHING) != j:
+                info.joins[k] = j
+                changed = True
+    if event == "call":
+        info.calls += 1
+        info.streak += 1
+    if changed:
+        info.streak = 0
+    elif info.streak >= CONVERGE:
+        info.traced = False  # the backends skip or disable its events
+        CONVERGED[info.filename, info.key] = info.calls
+
+
+def resample():
+    """ Trace the converged functions again until their next call, so that
+    the ones whose types have changed do not stay converged. """
+    for info in list(CODES.values()):
+        if info.rec is not None and not info.traced:
+            info.streak = CONVERGE - 1  # converge again after a call without new types
+            info.traced = True
+    if _backend == "monitoring":
+        sys.monitoring.restart_events()  # the events disabled by the callbacks
+
+
+def run_resampler(stopped: threading.Event):
+    while not stopped.wait(RESAMPLE):
+        resample()
+
+
+SIZED_TYPES = frozenset([list, tuple, dict, set, frozenset])
+
+
+def get_fingerprint(values) -> tuple:
+    """ A shallow summary of values: their classes, and the lengths of the
+    builtin collections capped at 5 (an empty collection and a tuple of each
+    length up to 4 have types of a different form).
+
+    >>> get_fingerprint([1, "a", [], (1, 2), list(range(9))])
+    (<class 'int'>, <class 'str'>, (<class 'list'>, 0), (<class 'tuple'>, 2), (<class 'list'>, 5))
+    """
+    return tuple((type(v), min(len(v), 5)) if type(v) in SIZED_TYPES else type(v)
+                 for v in values)
+
+
+def get_def_keys_of_file(filename) -> dict:
+    """ The cached `get_def_keys` of the current source of a file. """
+    try:
+        return DEFS[filename]
+    except KeyError:
+        pass
+    try:
+        with open(filename, encoding="utf8") as f:
+            keys = get_def_keys(ast.parse(f.read()))
+    except (OSError, SyntaxError, ValueError):
+        keys = {}
+    DEFS[filename] = keys
+    return keys
+
+
+def get_def_key(filename, code) -> Optional[tuple]:
+    """ The key (qualname, hash) of the records of a code object, which is
+    the same as `annotate_def` finds from the ast of its def, or None if it
+    has none and is not traced: a class body, an async def, or a function
+    that is not found in the source (e.g. it has been modified since it was
+    imported), whose records `prune_records` would remove. """
+    name = getattr(code, "co_qualname", code.co_name)
+    return get_def_keys_of_file(filename).get((code.co_firstlineno, name))
+
+
+def prune_records(records) -> bool:
+    """ Remove the records of the functions whose source has changed or that
+    no longer exist, and the ones of the files that no longer exist. Return
+    True if any record is removed.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "m.py")
+    >>> write_script(path, "def f(x):\\n    return x\\n")
+    >>> key = get_def_keys_of_file(path)[1, "f"]
+    >>> records = {path: {key: {}, ("f", "old hash"): {}, ("globals", None): {}},
+    ...            path + ".removed": {("g", "h"): {}}}
+    >>> prune_records(records)
+    True
+    >>> list(records) == [path], list(records[path]) == [key, ("globals", None)]
+    (True, True)
+    >>> prune_records(records)
+    False
+    """
+    pruned = False
+    for filename, recs in list(records.items()):
+        keys = set(get_def_keys_of_file(filename).values())
+        for key in list(recs):
+            if key not in keys and key != ("globals", None):
+                del recs[key]
+                pruned = True
+        if not recs:
+            del records[filename]
+            pruned = True
+    return pruned
+
+
+def sample(frame, event) -> bool:
+    """ Whether an event of a traced frame is recorded under RATE. The calls are
+    chosen at random, and a return is recorded if the call of its frame was, so
+    the records of a function never have arguments without a return.
+
+    >>> g, frame = sample.__globals__, object()
+    >>> g["RATE"] = 0.0  # no call is recorded
+    >>> sample(frame, "call")
+    False
+    >>> g["RATE"] = 1.0  # every call is recorded
+    >>> sample(frame, "return")  # but its call was left out
+    False
+    >>> sample(frame, "call"), sample(frame, "return")
+    (True, True)
+    >>> g["RATE"] = None
+    """
+    if event == "call":
+        if random.random() < RATE:
+            return True
+        _unsampled.add(id(frame))
+    elif id(frame) in _unsampled:
+        _unsampled.discard(id(frame))
+    else:
+        return True
+    EVENTS["unsampled"] += 1
+    return False
+
+
+# ** backend: sys.setprofile **
+
+def profiler(frame, event, arg):
+    if _backend is None:  # stopped by another thread, which cannot unset it here
+        sys.setprofile(None)
+        return
+    if event == "call" or event == "return":
+        code = frame.f_code
+        try:
+            info = CODES[id(code)]
+        except KeyError:
+            info = get_code_info(code)
+        if info.traced:
+            if RATE is not None and not sample(frame, event):
+                return profiler
+            EVENTS["traced"] += 1
+            record(info, frame, event, arg)
+            return profiler
+    EVENTS["skipped"] += 1
+    return profiler
+
+
+# ** backend: sys.monitoring (PEP 669) **
+
+def on_start(code, offset):
+    info = get_code_info(code)
+    if not info.traced:
+        EVENTS["skipped"] += 1
+        return sys.monitoring.DISABLE  # never called again for this code
+    frame = sys._getframe(1)
+    if RATE is not None and not sample(frame, "call"):
+        return  # not DISABLE, the next call of this code may be sampled
+    EVENTS["traced"] += 1
+    record(info, frame, "call", None)
+
+
+def on_return(code, offset, retval):
+    info = get_code_info(code)
+    if not info.traced:
+        EVENTS["skipped"] += 1
+        return sys.monitoring.DISABLE
+    frame = sys._getframe(1)
+    if RATE is not None and not sample(frame, "return"):
+        return
+    EVENTS["traced"] += 1
+    record(info, frame, "return", retval)
+
+
+def on_unwind(code, offset, exception):
+    # a frame exits by an exception: no return is recorded, but its probes are
+    # reported and forgotten (PY_UNWIND events cannot be disabled)
+    if _probes or _unsampled:
+        frame_id = id(sys._getframe(1))
+        _unsampled.discard(frame_id)
+        report_probes(_probes.pop(frame_id, ()))
+
+
+def start(backend="auto"):
+    """ Start collecting type records. `backend` is one of `BACKENDS`, or
+    "auto" to use sys.monitoring if it is available and one of its tool ids
+    is free. """
+    global _backend, _tool_id
+    if _backend is not None:
+        return
+    if backend == "auto":
+        _tool_id = get_free_tool_id()
+        backend = "setprofile" if _tool_id is None else "monitoring"
+    elif backend == "monitoring":
+        if not hasattr(sys, "monitoring"):
+            raise RuntimeError("the monitoring backend requires Python 3.12+")
+        _tool_id = get_free_tool_id()
+        if _tool_id is None:
+            raise RuntimeError(
+                "the monitoring backend needs a free sys.monitoring tool id, but "
+                f"{TOOL_IDS} are used by other tools (e.g. a profiler); use the "
+                "setprofile backend instead"
+            )
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend: {backend}")
+    open_log()
+    _backend = backend  # before the hooks, which remove themselves without it
+    if backend == "monitoring":
+        M = sys.monitoring
+        M.use_tool_id(_tool_id, "auto-anno")
+        M.register_callback(_tool_id, M.events.PY_START, on_start)
+        M.register_callback(_tool_id, M.events.PY_RETURN, on_return)
+        M.register_callback(_tool_id, M.events.PY_UNWIND, on_unwind)
+        M.set_events(_tool_id, M.events.PY_START | M.events.PY_RETURN | M.events.PY_UNWIND)
+        # the code disabled by a previous window may be traced now, e.g. after
+        # CODES has been reset for another CWD
+        M.restart_events()
+    elif backend == "setprofile":
+        if hasattr(threading, "setprofile_all_threads"):  # Python 3.12+
+            threading.setprofile_all_threads(profiler)
+        else:  # the threads started from now on
+            threading.setprofile(profiler)
+            sys.setprofile(profiler)
+    start_threads()
+
+
+def get_free_tool_id():
+    """ The first of TOOL_IDS that no tool uses, or None if they are all used
+    or sys.monitoring is not available. """
+    if not hasattr(sys, "monitoring"):
+        return None
+    for i in TOOL_IDS:
+        if sys.monitoring.get_tool(i) is None:
+            return i
+    return None
+
+
+def collecting() -> bool:
+    return _backend is not None
+
+
+def reset():
+    """ Forget the records, the counters and the caches of the code objects,
+    e.g. between benchmarks. Must not be called while collecting. """
+    TYPE_RECS.clear()
+    for cache in (CODES, DEFS, GLOBALS, CONVERGED, BUFFERS, STATS or {}):
+        cache.clear()
+    _local.__dict__.clear()
+    for k in EVENTS:
+        EVENTS[k] = 0
+
+
+def start_threads():
+    """ Start the threads that resample the converged functions and flush the
+    records to LOG, if they are enabled. """
+    global _resampler, _flusher
+    _resampler = _flusher = None
+    if CONVERGE and RESAMPLE:
+        _resampler = threading.Event()
+        threading.Thread(target=run_resampler, args=(_resampler,), daemon=True).start()
+    if LOG is not None and FLUSH:
+        _flusher = threading.Event()
+        threading.Thread(target=run_flusher, args=(_flusher,), daemon=True).start()
+
+
+def stop():
+    """ Stop collecting type records. """
+    global _backend, _resampler, _flusher
+    if _resampler is not None:
+        _resampler.set()
+        _resampler = None
+    if _flusher is not None:
+        _flusher.set()
+        _flusher = None
+    for index in GLOBALS.values():
+        index.refresh()
+    if _backend == "monitoring":
+        M = sys.monitoring
+        M.set_events(_tool_id, 0)
+        M.register_callback(_tool_id, M.events.PY_START, None)
+        M.register_callback(_tool_id, M.events.PY_RETURN, None)
+        M.register_callback(_tool_id, M.events.PY_UNWIND, None)
+        M.free_tool_id(_tool_id)
+    elif _backend == "setprofile":
+        if hasattr(threading, "setprofile_all_threads"):
+            threading.setprofile_all_threads(None)
+        else:
+            threading.setprofile(None)
+            sys.setprofile(None)
+    _backend = None
+    for probes in list(_probes.values()):  # of the frames that have not returned
+        report_probes(probes)
+    _probes.clear()
+    _unsampled.clear()
+    close_log()
+    flush()
+
+
+# ** log **
+
+def open_log():
+    """ Start new shards of LOG, which will only get the counts that the
+    records gain from now on. """
+    _shards.clear()
+    if LOG is not None:
+        os.makedirs(LOG, exist_ok=True)
+        _shards[None] = log.Shard(LOG, TYPE_RECS)
+
+
+def write_log():
+    """ Append the new counts of the records of every thread to LOG. """
+    if not _shards:  # not collecting, or no LOG
+        return
+    shards = [(_shards[None], TYPE_RECS)]
+    for buffer in list(BUFFERS):
+        if not buffer.main:
+            try:
+                shard = _shards[id(buffer)]
+            except KeyError:
+                shard = _shards[id(buffer)] = log.Shard(LOG)
+            shards.append((shard, buffer.records))
+    for shard, records in shards:
+        try:
+            shard.write(records)
+        except FileNotFoundError:  # the parent has already merged the shards
+            pass
+
+
+def close_log():
+    write_log()
+    for shard in _shards.values():
+        shard.close()
+    _shards.clear()
+
+
+def run_flusher(stopped: threading.Event):
+    while not stopped.wait(FLUSH):
+        write_log()
+
+
+# ** statistics **
+
+def merge_stats(dst: dict, src: dict):
+    for key, (events, times) in src.items():
+        stats = dst.setdefault(key, [0, {}])
+        stats[0] += events
+        for k, t in times.items():
+            stats[1][k] = stats[1].get(k, 0.0) + t
+
+
+def get_stats_report() -> list:
+    """ The STATS of the traced functions, with the number of distinct types
+    of each argument in TYPE_RECS, sorted by the time spent in get_type. """
+    rows = []
+    for (filename, key), (events, times) in STATS.items():
+        rec = TYPE_RECS.get(filename, {}).get(key, {})
+        args = {k: {"time": t, "types": len(rec.get(k, ()))}
+                for k, t in sorted(times.items(), key=lambda kv: -kv[1])}
+        rows.append({"file": filename, "function": key[0], "events": events,
+                     "time": sum(times.values()), "args": args})
+    rows.sort(key=lambda r: (-r["time"], -r["events"]))
+    return rows
+
+
+def format_stats_report(rows) -> str:
+    lines = [f"{'get_type (s)':>12} {'events':>9} {'us/event':>9}  function",
+             f"{'':>12} {'':>9} {'':>9}    argument: get_type (s), distinct types"]
+    for r in rows:
+        us = r["time"] / r["events"] * 1e6 if r["events"] else 0
+        lines.append(f"{r['time']:>12.4f} {r['events']:>9} {us:>9.1f}  "
+                     f"{os.path.relpath(r['file'], CWD)} {r['function']}")
+        for k, a in r["args"].items():
+            lines.append(f"{'':>12} {'':>9} {'':>9}    {k}: {a['time']:.4f}, {a['types']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_stats_report(path) -> tuple:
+    """ Write the report of STATS as text and JSON to the directory `path`,
+    returning the paths of the files. """
+    rows = get_stats_report()
+    os.makedirs(path, exist_ok=True)
+    txt, js = (os.path.join(path, log.STATS + ext) for ext in (".txt", ".json"))
+    with open(txt, "w") as f:
+        f.write(format_stats_report(rows))
+    with open(js, "w") as f:
+        json.dump(rows, f, indent=1)
+    return txt, js
+
+
+# ** child processes **
+
+def trace_children(backend="auto"):
+    """ Make the child processes started from now on collect type records and
+    write them to a new log SHARDS. """
+    global SHARDS
+    import multiprocessing.util
+
+    tmpdir = tempfile.mkdtemp(prefix="auto-anno-")
+    SHARDS = os.path.join(tmpdir, "shards")
+    os.mkdir(SHARDS)
+
+    # forked children inherit the collector, but not the records of the parent
+    os.register_at_fork(after_in_child=_after_fork)
+    # multiprocessing clears the exit handlers of its children after forking
+    # and exits them without running atexit
+    multiprocessing.util.register_after_fork(dump_shard, _dump_shard_at_exit)
+
+    # spawned Python processes import sitecustomize from PYTHONPATH at startup
+    site = os.path.join(tmpdir, "site")
+    os.mkdir(site)
+    package = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(site, "sitecustomize.py"), "w") as f:
+        f.write(SITECUSTOMIZE.format(path=os.path.dirname(package),
+                                     package=os.path.basename(package)))
+    global _pythonpath
+    _pythonpath = os.environ.get("PYTHONPATH")
+    os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [site, _pythonpath]))
+    os.environ[CHILD_ENV] = json.dumps({
+        "backend": backend,
+        "cwd": CWD,
+        "shards": SHARDS,
+        "sampling": SAMPLING and [SAMPLING.size, SAMPLING.depth, SAMPLING.mode],
+        "recheck": RECHECK,
+        "converge": CONVERGE,
+        "probe": PROBE,
+        "flush": FLUSH,
+        "stats": STATS is not None,
+        "array_shapes": lib.ARRAY_SHAPES,
+    })
+
+
+SITECUSTOMIZE = """\
+# written by auto-anno to collect type records in this process
+import os, sys, importlib, importlib.machinery, importlib.util
+sys.path.insert(0, {path!r})
+try:
+    importlib.import_module({package!r} + ".collect").start_child()
+finally:
+    sys.path.remove({path!r})
+    # run the sitecustomize module that this one shadows, if any
+    site = os.path.dirname(os.path.abspath(__file__))
+    path = [p for p in sys.path if os.path.abspath(p) != site]
+    spec = importlib.machinery.PathFinder.find_spec("sitecustomize", path)
+    if spec is not None:
+        spec.loader.exec_module(importlib.util.module_from_spec(spec))
+"""
+
+
+def start_child():
+    """ Start collecting type records in a child process, configured by the
+    environment variable CHILD_ENV. """
+    global CWD, SHARDS, LOG, FLUSH, SAMPLING, RECHECK, CONVERGE, PROBE, STATS
+    import multiprocessing.util
+
+    config = json.loads(os.environ[CHILD_ENV])
+    backend = config["backend"]
+    if backend == "monitoring" and not hasattr(sys, "monitoring"):
+        backend = "setprofile"  # another Python version
+    CWD = config["cwd"]
+    SHARDS = LOG = config["shards"]
+    FLUSH = config["flush"]
+    if config["sampling"]:
+        SAMPLING = Sampling(*config["sampling"])
+    RECHECK = config["recheck"]
+    CONVERGE = config["converge"]
+    PROBE = config["probe"]
+    if config["stats"]:
+        STATS = {}
+    lib.ARRAY_SHAPES = config["array_shapes"]
+
+    os.register_at_fork(after_in_child=_after_fork)
+    multiprocessing.util.register_after_fork(dump_shard, _dump_shard_at_exit)
+    atexit.register(dump_shard)
+    _dump_shard_on_sigterm()
+    start(backend)
+
+
+def _after_fork():
+    global _dumped, _dumping, _terminated, LOG
+    if SHARDS is None or _backend is None:
+        return
+    for recs in TYPE_RECS.values():
+        for key, rec in recs.items():
+            if key != ("globals", None):
+                for counts in rec.values():
+                    counts.clear()
+    for buffer in BUFFERS:
+        if not buffer.main:
+            buffer.swap()
+    BUFFERS[:] = [b for b in BUFFERS if b.thread is threading.current_thread()]
+    for k in EVENTS:
+        EVENTS[k] = 0
+    for stats in (STATS or {}).values():  # in place, they are shared with CODES
+        stats[0] = 0
+        stats[1].clear()
+    LOG = SHARDS
+    open_log()  # the shards of the parent are not written by the child
+    start_threads()  # only the forking thread runs in the child
+    _dumped = _dumping = _terminated = False
+    atexit.register(dump_shard)
+    _dump_shard_on_sigterm()
+
+
+def _dump_shard_at_exit(_):
+    import multiprocessing.util
+    multiprocessing.util.Finalize(None, dump_shard, exitpriority=0)
+
+
+def _dump_shard_on_sigterm():
+    """ Dump the records before being terminated, e.g. by Pool.terminate,
+    which multiprocessing.Pool.__exit__ calls. If the signal interrupts a
+    dump (e.g. by the exit finalizer of a pool worker), the process is killed
+    when the dump ends. """
+    def on_sigterm(signum, frame):
+        global _terminated
+        if _dumping:
+            _terminated = True
+            return
+        dump_shard()
+        _terminate()
+    try:
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, on_sigterm)
+    except ValueError:  # not in the main thread
+        pass
+
+
+def _terminate():
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def dump_shard():
+    """ Stop collecting and write the records of this process to SHARDS. """
+    global _dumped, _dumping
+    if _dumped or _dumping:
+        return
+    _dumping = True
+    try:
+        stop()
+        if STATS:
+            name = f"{os.getpid()}-{os.urandom(4).hex()}{STATS_SUFFIX}"
+            with open(os.path.join(SHARDS, name), "wb") as f:
+                cloudpickle.dump(STATS, f)
+    finally:
+        _dumping = False
+    _dumped = True  # only once the shards are closed
+    if _terminated:
+        _terminate()
+
+
+def merge_shards():
+    """ Add the records (and the STATS) of the child processes to TYPE_RECS
+    (and STATS) and move their shards to LOG. """
+    global SHARDS
+    if SHARDS is None:
+        return
+    merge_records(TYPE_RECS, log.read_log(SHARDS))
+    if STATS is not None:
+        for name in sorted(os.listdir(SHARDS)):
+            if name.endswith(STATS_SUFFIX):
+                with open(os.path.join(SHARDS, name), "rb") as f:
+                    merge_stats(STATS, cloudpickle.load(f))
+    if LOG is not None:
+        os.makedirs(LOG, exist_ok=True)
+        for shard in log.get_shards(SHARDS):
+            shutil.move(shard, LOG)
+    shutil.rmtree(os.path.dirname(SHARDS))
+    SHARDS = None
+    os.environ.pop(CHILD_ENV, None)
+    if _pythonpath is None:
+        os.environ.pop("PYTHONPATH", None)
+    else:
+        os.environ["PYTHONPATH"] = _pythonpath
+
+
+def index_modules(namespaces=None):
+    """ Index the globals of the modules whose functions have records but
+    were not traced in this process, e.g. they were only called by child
+    processes. `namespaces` is {filename: globals} of modules that are not in
+    sys.modules, such as the scripts run by runpy. The modules that are not
+    loaded are indexed by the names that their imports bind. """
+    namespaces = dict(namespaces or {})
+    for mod in list(sys.modules.values()):
+        filename = getattr(mod, "__file__", None)
+        if filename:
+            namespaces.setdefault(os.path.abspath(filename), vars(mod))
+    for filename, recs in TYPE_RECS.items():
+        if ("globals", None) in recs:
+            continue
+        if filename in namespaces:
+            get_globals_index(filename, namespaces[filename], recs).refresh()
+        else:
+            get_globals_index(filename, get_imported_globals(filename), recs)
+
+
+def get_imported_globals(filename) -> dict:
+    """ The globals bound by the imports at the top level of a module (also
+    under `if` and `try`), without running it. The imports that fail are
+    left out. """
+    try:
+        with open(filename, encoding="utf8") as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError, ValueError):
+        return {}
+    package = get_package(filename)
+    imported = {}
+
+    def visit(body):
+        for node in body:
+            if isinstance(node, (ast.If, ast.Try)):
+                handlers = [c for h in getattr(node, "handlers", ()) for c in h.body]
+                visit(node.body + handlers + node.orelse + getattr(node, "finalbody", []))
+            elif isinstance(node, ast.Import):
+                for a in node.names:
+                    try:
+                        mod = importlib.import_module(a.name)
+                    except Exception:
+                        continue
+                    if a.asname:
+                        imported[a.asname] = mod
+                    else:  # `import a.b` binds a
+                        name = a.name.split(".")[0]
+                        imported[name] = sys.modules[name]
+            elif isinstance(node, ast.ImportFrom):
+                try:
+                    mod = importlib.import_module("." * node.level + (node.module or ""), package)
+                except Exception:
+                    continue
+                for a in node.names:
+                    if a.name == "*":
+                        imported.update((k, v) for k, v in vars(mod).items() if k[0] != "_")
+                        continue
+                    try:
+                        v = getattr(mod, a.name)
+                    except AttributeError:  # a submodule that is not loaded
+                        try:
+                            v = importlib.import_module(f"{mod.__name__}.{a.name}")
+                        except Exception:
+                            continue
+                    imported[a.asname or a.name] = v
+
+    visit(tree.body)
+    return imported
+
+
+def get_package(filename) -> Optional[str]:
+    """ The name of the package of a module, from the __init__.py files of
+    its directory and their parents. """
+    parts = []
+    path = os.path.dirname(os.path.abspath(filename))
+    while os.path.exists(os.path.join(path, "__init__.py")):
+        path, name = os.path.split(path)
+        parts.insert(0, name)
+    return ".".join(parts) or None
+
+
+# ** worker processes **
+
+def run_script(argv) -> dict:
+    """ Run a script like `python *argv` and return its globals. """
+    sys.argv = list(argv)
+    return runpy.run_path(argv[0], run_name="__main__")
+
+
+def export_records() -> dict:
+    """ The non-empty records of TYPE_RECS without the globals indices, whose
+    object ids are only valid in this process. """
+    records = {}
+    for filename, recs in TYPE_RECS.items():
+        for key, rec in recs.items():
+            if key == ("globals", None):
+                continue
+            rec = {k: counts for k, counts in rec.items() if counts}
+            if rec:
+                records.setdefault(filename, {})[key] = rec
+    return records
+
+
+def export_globals() -> dict:
+    """ {filename: {name: value}} of the public classes, modules and type
+    aliases of the indexed modules, which can be pickled along with the
+    records to index them in another process. """
+    namespaces = {}
+    for filename, index in GLOBALS.items():
+        namespaces[filename] = {
+            k: v for k, v in index.module_globals.items()
+            if k[0] != "_" and (inspect.isclass(v) or inspect.ismodule(v)
+                                or hasattr(v, "__origin__"))
+        }
+    return namespaces
+
+
+def run_job(argv, backend="auto", children=False) -> bytes:
+    """ Collect the types of a run of `python *argv` in a fresh worker process
+    (forked before any script has run). Returns the pickled records, globals
+    and counters of the run, which are merged into this process by `load_job`.
+    """
+    global TYPE_RECS
+    TYPE_RECS = {}
+    if children:
+        trace_children(backend)
+    start(backend)
+    pid = os.getpid()
+    try:
+        script_globals = run_script(argv)
+    except SystemExit as e:
+        if e.code or os.getpid() != pid:  # or in a process forked by the script
+            raise
+        script_globals = {}
+    finally:
+        stop()
+    if children:
+        merge_shards()
+        index_modules({os.path.abspath(argv[0]): script_globals})
+    return cloudpickle.dumps(
+        (export_records(), export_globals(), EVENTS, CONVERGED, STATS))
+
+
+def load_job(data: bytes):
+    """ Merge the result of `run_job` into the records of this process. """
+    records, namespaces, events, converged, stats = cloudpickle.loads(data)
+    merge_records(TYPE_RECS, records)
+    index_modules(namespaces)
+    for k, n in events.items():
+        EVENTS[k] += n
+    for k, n in converged.items():
+        CONVERGED.setdefault(k, n)
+    if STATS is not None:
+        merge_stats(STATS, stats)
+
+
+def run_jobs(runs, jobs, **kwargs) -> list:
+    """ Call `run_job(argv, **kwargs)` for each argv in `runs`, in at most
+    `jobs` forked processes at a time. The processes are not daemonic, so the
+    scripts can start their own, and each one runs a single job. Returns the
+    results in the order of `runs`. """
+    import multiprocessing.connection
+    ctx = multiprocessing.get_context("fork")
+    results = [None] * len(runs)
+    pending = list(enumerate(runs))[::-1]
+    running = {}  # {connection: (index, process)}
+    try:
+        while pending or running:
+            while pending and len(running) < jobs:
+                i, argv = pending.pop()
+                recv, send = ctx.Pipe(duplex=False)
+                proc = ctx.Process(target=_job_worker, args=(send, argv), kwargs=kwargs)
+                proc.start()
+                send.close()
+                running[recv] = (i, proc)
+            for conn in multiprocessing.connection.wait(list(running)):
+                i, proc = running.pop(conn)
+                try:
+                    ok, results[i] = conn.recv()
+                except EOFError:  # the process died
+                    proc.join()
+                    ok, results[i] = False, f"exit code {proc.exitcode}"
+                proc.join()
+                if not ok:
+                    raise RuntimeError(f"{shlex.join(runs[i])} failed:\n{results[i]}")
+    finally:
+        for _, proc in running.values():
+            proc.terminate()
+    return results
+
+
+def _job_worker(conn, argv, **kwargs):
+    pid = os.getpid()
+    try:
+        result = True, run_job(argv, **kwargs)
+    except BaseException:
+        if os.getpid() != pid:
+            raise
+        result = False, traceback.format_exc()
+    conn.send(result)
+    conn.close()
+
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
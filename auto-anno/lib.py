@@ -1,16 +1,24 @@
 import io
+import os
 import re
 import ast
+import copy
+import array
+import hashlib
+import random
 import isort
 import black
+import shutil
 import inspect
+import contextlib
+import multiprocessing
 from numbers import *
 from functools import partial
 from importlib import import_module
 from itertools import islice, product
 from typing import Any, Optional, Union
 from collections import defaultdict
-from collections.abc import Callable, Iterator
+from collections.abc import Callable, Iterable, Iterator, Sequence
 
 
 TYPE_MAP = {  # maps of type annotations
@@ -20,10 +28,16 @@ TYPE_MAP = {  # maps of type annotations
     object: Any,
 }
 
-REQ_IMPORTS = {Any, Optional, Union, Callable, Iterator}
+REQ_IMPORTS = {Any, Optional, Union, Callable, Iterable, Iterator}
 
+TYPE_DESCRIPTORS = {}  # {class or its full name: function returning the type of an instance}
 
-def get_type(x):
+ARRAY_SHAPES = False  # whether the types of numpy arrays include their number of dimensions
+
+MAX_DEPTH = 32  # the collections nested deeper than this are not inspected
+
+
+def get_type(x, sampling: Optional["Sampling"]=None):
     """
     Examples:
     >>> f = lambda x: print(get_full_name(get_type(x)))
@@ -51,12 +65,151 @@ def get_type(x):
     tuple[Integral, ...]
     >>> f(iter(range(9)))
     Iterator[Integral]
+
+    Other iterators are not consumed, unless they are wrapped in a probe:
     >>> f((i if i % 2 else None for i in range(9)))
+    Iterator
+    >>> it = IteratorProbe(i if i % 2 else None for i in range(9))
+    >>> sum(1 for _ in it)
+    9
+    >>> f(it)
     Iterator[Optional[Integral]]
+    >>> f(range(10**9))
+    Iterable[Integral]
+    >>> f(b"abc")
+    bytes
+
+    Each object is inspected once, and a cycle gets the bare type of the
+    collection it comes back to:
+    >>> shared = [1.0]
+    >>> f([shared] * 1000)
+    list[list[Real]]
+    >>> a = []
+    >>> a.append(a)
+    >>> f(a)
+    list[list]
+
+    Large or deeply nested collections can be sampled:
+    >>> g = lambda x: print(get_full_name(get_type(x, Sampling(size=2, depth=1))))
+    >>> g([1, 2, 'a'])
+    list[Integral]
+    >>> g(tuple(range(9)))
+    tuple[Integral, ...]
+    >>> g([[1], [2]])
+    list[list]
+    """
+    return TypeInference(sampling)(x)
+
+
+class Sampling:
+    """ Bounds the work of `get_type` on large or deeply nested collections.
+
+    Only `size` elements of each collection are inspected, selected by `mode`:
+    - "head": the first elements
+    - "stride": evenly spaced elements
+    - "random": random elements (strided for collections that are not sequences)
+    The elements of collections nested deeper than `depth` are not inspected.
     """
 
-    def dispatch(T, *xs, maxlen=4):
-        xs = [list(map(get_type, l)) for l in xs]
+    MODES = ("head", "stride", "random")
+
+    def __init__(self, size=100, depth=4, mode="head", seed=0):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown sampling mode: {mode}")
+        if size < 1:
+            raise ValueError(f"the sampling size must be at least 1: {size}")
+        if depth < 0:
+            raise ValueError(f"the sampling depth must not be negative: {depth}")
+        self.size = size
+        self.depth = depth
+        self.mode = mode
+        self.rng = random.Random(seed)
+
+    def sample(self, xs):
+        n, k = len(xs), self.size
+        seq = isinstance(xs, Sequence)
+        if self.mode == "random" and seq:
+            return [xs[i] for i in sorted(self.rng.sample(range(n), k))]
+        if self.mode == "head":
+            return xs[:k] if seq else islice(xs, k)
+        step = -(-n // k)
+        return xs[::step] if seq else islice(xs, 0, None, step)
+
+
+class TypeInference:
+    """ Infers the types of values like `get_type`. `sampled` is set to True
+    when a collection is sampled during the inference.
+
+    The types of the collections are memoized by their ids, which are only
+    valid while the inspected values are alive, e.g. during a call event. """
+
+    def __init__(self, sampling: Optional[Sampling]=None):
+        self.sampling = sampling
+        self.sampled = False
+        self.memo = {}  # {id(collection): its type}
+        self.active = set()  # the ids of the collections being inspected
+
+    def __call__(self, x, depth=0):
+        if x is None:
+            return None
+        describe = get_type_descriptor(type(x))
+        if describe is not None:
+            return describe(x)
+        if inspect.isfunction(x) or inspect.ismethod(x):
+            return Callable
+        for T in (list, set, frozenset, tuple, dict):
+            if isinstance(x, T):
+                return self.collection(T, x, depth)
+        if isinstance(x, io.IOBase):  # a virtual base class of file objects
+            return type(x)
+        if isinstance(x, IteratorProbe):
+            return x.get_type()
+        if isinstance(x, Iterator):  #! may be too general
+            if type(x) in COPYABLE_ITERATORS:  # inspect a copy
+                return self.dispatch(Iterator, depth, islice(copy.copy(x), 10))
+            return Iterator  # consuming it would change the program
+        if isinstance(x, bool):
+            return bool
+        if isinstance(x, Integral):
+            return Integral
+        if isinstance(x, Real):
+            return Real
+        if isinstance(x, Complex):
+            return Complex
+        return type(x)
+
+    def collection(self, T, x, depth):
+        key = id(x)
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        if key in self.active or depth >= MAX_DEPTH:
+            return T  # the placeholder of a recursive type
+        self.active.add(key)
+        try:
+            if T is dict:
+                t = self.dispatch(dict, depth, x.keys(), x.values())
+            elif T is not tuple:
+                t = self.dispatch(T, depth, x)
+            elif self.sampling is not None and len(x) > self.sampling.size:
+                # too long to inspect each position, use tuple[t, ...]
+                t = self.dispatch(tuple, depth, x, variadic=True)
+            else:
+                t = self.dispatch(tuple, depth, *[[a] for a in x])
+        finally:
+            self.active.discard(key)
+        self.memo[key] = t
+        return t
+
+    def dispatch(self, T, depth, *xs, maxlen=4, variadic=False):
+        if self.sampling is not None:
+            if depth >= self.sampling.depth:
+                if T is not Iterator and any(xs):
+                    self.sampled = True
+                return T
+            xs = [self.sample(l) for l in xs]
+        xs = [[self(a, depth + 1) for a in l] for l in xs]
         if not xs or min(map(len, xs)) == 0:  # empty collection
             return T
         ts = tuple(map(get_common_suptype, xs))
@@ -68,69 +221,157 @@ def get_type(x):
             t = ts
         if t is object:
             return T
-        elif len(ts) > maxlen:
+        elif len(ts) > maxlen or variadic:
             return T[t, ...]
         else:
             return T[t]
 
-    if x is None:
-        return None
-    if inspect.isfunction(x) or inspect.ismethod(x):
-        return Callable
-    for t in (list, set, frozenset):
-        if isinstance(x, t):
-            return dispatch(t, x)
-    if isinstance(x, tuple):
-        return dispatch(tuple, *[[a] for a in x])
-    if isinstance(x, dict):
-        return dispatch(dict, x.keys(), x.values())
-    if isinstance(x, io.IOBase):
-        return type(x)
-    if isinstance(x, Iterator):  #! may be too general
-        return dispatch(Iterator, islice(x, 10))
-    if isinstance(x, bool):
-        return bool
-    if isinstance(x, Integral):
-        return Integral
-    if isinstance(x, Real):
-        return Real
-    if isinstance(x, Complex):
-        return Complex
-    return type(x)
+    def sample(self, xs):
+        if not hasattr(xs, "__len__") or len(xs) <= self.sampling.size:
+            return xs
+        self.sampled = True
+        return self.sampling.sample(xs)
+
+
+# the iterators over sequences, whose copies are independent and cheap
+COPYABLE_ITERATORS = frozenset(type(iter(x)) for x in ([], (), range(0), ""))
+
+# the plain iterators that can be replaced by an IteratorProbe: they have no
+# other methods, are not context managers and are rarely checked by type
+PROBED_ITERATORS = frozenset({map, filter, zip, enumerate, reversed})
+
+
+def is_probed(x) -> bool:
+    """ Whether an iterator argument can be wrapped in an IteratorProbe.
+    Generators, file-like iterators and other iterators with their own
+    methods are not, since no proxy can pass their type checks and special
+    methods through.
+
+    >>> is_probed(map(str, [1, 2]))
+    True
+    >>> is_probed(x for x in [1, 2])
+    False
+    >>> import os
+    >>> with os.scandir(".") as entries:  # a context manager
+    ...     is_probed(entries)
+    False
+    >>> is_probed(iter([1, 2]))  # inspected through a copy
+    False
+    """
+    return type(x) in PROBED_ITERATORS
+
+
+class IteratorProbe:
+    """ A proxy of an iterator, which infers the types of the first `size`
+    elements as the program consumes them, instead of consuming the iterator
+    to infer its type. Only the iterators for which `is_probed` is true are
+    wrapped while collecting, since the proxy has another type. """
+
+    __slots__ = ("iterator", "size", "types", "count", "infer")
+
+    def __init__(self, iterator, size=10, sampling: Optional[Sampling]=None):
+        self.iterator = iterator
+        self.size = size
+        self.types = set()  # the distinct types of the probed elements
+        self.count = 0  # the number of probed elements
+        self.infer = TypeInference(sampling)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        x = next(self.iterator)
+        if self.count < self.size:
+            self.count += 1
+            self.types.add(self.infer(x, 1))
+            self.infer.memo.clear()  # x may be freed and its id reused
+        return x
+
+    def __getattr__(self, name):  # e.g. send, throw and close of generators
+        return getattr(self.iterator, name)
+
+    def get_type(self):
+        """ The type of the iterator inferred from the elements probed so far. """
+        if not self.types:
+            return Iterator
+        t = get_common_suptype(self.types)
+        return Iterator if t is object else Iterator[t]
+
+
+# ** constant-time type descriptors **
+
+_descriptors = {}  # {class: descriptor of the class or its closest base}
+
+
+def register_type_descriptor(cls):
+    """ Register a function that describes the type of an instance of `cls`
+    (or of its subclasses) in constant time, instead of inspecting its elements.
+    `cls` can be given by its full name, e.g. "numpy.ndarray", so that its
+    module is not imported until such an instance is seen.
+
+    Examples:
+    >>> from fractions import Fraction
+    >>> @register_type_descriptor("fractions.Fraction")
+    ... def describe_fraction(x):
+    ...     return Rational
+    >>> get_type(Fraction(1, 3))
+    <class 'numbers.Rational'>
+    """
+    def register(describe):
+        TYPE_DESCRIPTORS[cls] = describe
+        _descriptors.clear()
+        return describe
+    return register
+
+
+def get_type_descriptor(cls) -> Optional[Callable]:
+    try:
+        return _descriptors[cls]
+    except KeyError:
+        pass
+    describe = None
+    for c in cls.__mro__:
+        describe = (TYPE_DESCRIPTORS.get(c) or
+                    TYPE_DESCRIPTORS.get(f"{c.__module__}.{c.__qualname__}"))
+        if describe is not None:
+            break
+    _descriptors[cls] = describe
+    return describe
+
+
+for _cls in (bytes, bytearray, memoryview,
+             "pandas.core.series.Series",
+             "pandas.core.frame.DataFrame",
+             "pandas.core.indexes.base.Index"):
+    register_type_descriptor(_cls)(type)
+
+
+@register_type_descriptor(range)
+def describe_range(x):
+    return Iterable[Integral]
+
+
+ARRAY_TYPECODES = {**dict.fromkeys("bBhHiIlLqQ", Integral),
+                   **dict.fromkeys("fd", Real), "u": str, "w": str}
+
+
+@register_type_descriptor(array.array)
+def describe_array(x):
+    if not hasattr(array.array, "__class_getitem__"):  # before Python 3.12
+        return array.array
+    return array.array[ARRAY_TYPECODES.get(x.typecode, Any)]
+
+
+@register_type_descriptor("numpy.ndarray")
+def describe_ndarray(x):
+    import numpy as np
+    shape = tuple[(int,) * x.ndim] if ARRAY_SHAPES and x.ndim else Any
+    return type(x)[shape, np.dtype[x.dtype.type]]
 
 
 def get_suptypes(t, type_map: Optional[dict]=None):
     """ Get all supertypes of a type. """
-    
-    def suptypes_of_subscripted_type(t):
-        T = t.__origin__
-        args = t.__args__
-        sts = [T[ts] for ts in 
-               product(*[get_suptypes(t, type_map) for t in args])
-               if not (T is Union and object in ts)
-               if not (T is tuple and set(ts) == {object, ...})
-               if not all(t is object for t in ts)]
-        return sts + get_suptypes(T, type_map)
-
-    if hasattr(t, "__origin__"):
-        sts = suptypes_of_subscripted_type(t)
-    elif inspect.isclass(t):
-        if issubclass(t, type):
-            sts = list(t.__mro__)
-        else:
-            sts = list(t.mro())
-    elif t in (Ellipsis, None, Any):
-        sts = [t]
-    elif t in (Optional, Union):
-        sts = [object]
-    elif type(t) is str:  # used type name as annotation
-        sts = [t, object]
-    else:
-        raise TypeError(f"unsupported type: {t}")
-
-    if type_map:
-        sts = [type_map.get(t, t) for t in sts]
-    return sts
+    return list(get_lattice(type_map).suptypes(t))
 
 
 def get_common_suptype(ts, type_map=None):
@@ -145,11 +386,8 @@ def get_common_suptype(ts, type_map=None):
     if not ts:
         return None
 
-    sts = [get_suptypes(t, type_map) for t in ts]
-    for t in min(sts, key=len):
-        if all(t in ts for ts in sts):
-            break
-    else:
+    t = get_lattice(type_map).join(frozenset(ts))
+    if t is NOTHING:
         return Any
 
     if optional:
@@ -157,14 +395,179 @@ def get_common_suptype(ts, type_map=None):
     return t
 
 
+NOTHING = object()  # the join of types without a common supertype
+
+_lattices = {}  # {id(type_map): (type_map, TypeLattice)}
+
+
+def get_lattice(type_map: Optional[dict]=None) -> "TypeLattice":
+    """ Get the memoized lattice of a type map, which should not be mutated. """
+    try:
+        return _lattices[id(type_map)][1]
+    except KeyError:
+        lattice = TypeLattice(type_map)
+        _lattices[id(type_map)] = (type_map, lattice)  # keep the id reserved
+        return lattice
+
+
+class TypeLattice:
+    """ Memoized supertypes and joins of types, with the types mapped by
+    `type_map`.
+
+    `suptypes` enumerates the Cartesian product of the supertypes of the
+    arguments of a subscripted type, whose size is exponential in its depth.
+    `join` does not: the join of subscripted types with the same origin is
+    built from the joins of their arguments, from the innermost types outward,
+    and only plain types are compared through their supertype chains. It finds
+    the same type as the first common supertype in the `suptypes` lists.
+    """
+
+    def __init__(self, type_map: Optional[dict]=None):
+        self.type_map = type_map or {}
+        self.suptypes_cache = {}  # {type: supertypes}
+        self.chains = {}  # {type: supertypes that are not subscripted}
+        self.heads = {}  # {type: the first of its supertypes}
+        self.joins = {}  # {frozenset of types: join}
+
+    def suptypes(self, t) -> tuple:
+        try:
+            return self.suptypes_cache[t]
+        except KeyError:
+            pass
+        if hasattr(t, "__origin__"):
+            T = t.__origin__
+            sts = [T[ts] for ts in product(*map(self.suptypes, t.__args__))
+                   if not self.excluded(T, ts)]
+            sts = tuple(sts) + self.suptypes(T)
+        else:
+            sts = self.chain(t)
+        self.suptypes_cache[t] = sts
+        return sts
+
+    def chain(self, t) -> tuple:
+        """ The supertypes of `t` that are not subscripted. """
+        try:
+            return self.chains[t]
+        except KeyError:
+            pass
+        if hasattr(t, "__origin__"):
+            sts = self.chain(t.__origin__)
+        else:
+            if inspect.isclass(t):
+                if issubclass(t, type):
+                    sts = list(t.__mro__)
+                else:
+                    sts = list(t.mro())
+            elif t in (Ellipsis, None, Any):
+                sts = [t]
+            elif t in (Optional, Union):
+                sts = [object]
+            elif type(t) is str:  # used type name as annotation
+                sts = [t, object]
+            else:
+                raise TypeError(f"unsupported type: {t}")
+            sts = tuple(self.type_map.get(t, t) for t in sts)
+        self.chains[t] = sts
+        return sts
+
+    @staticmethod
+    def excluded(T, ts) -> bool:
+        """ Whether T[ts] is too general to be a supertype. """
+        return ((T is Union and object in ts)
+                or (T is tuple and set(ts) == {object, ...})
+                or all(t is object for t in ts))
+
+    def head(self, t):
+        """ The first (most specific) supertype of `t` after mapping. """
+        try:
+            return self.heads[t]
+        except KeyError:
+            pass
+        if hasattr(t, "__origin__"):
+            T = t.__origin__
+            ts = tuple(map(self.head, t.__args__))
+            # if the first product of the supertypes of the arguments is
+            # excluded, all of them are, since each of these is `object`
+            h = self.head(T) if self.excluded(T, ts) else T[ts]
+        else:
+            h = self.chain(t)[0]
+        self.heads[t] = h
+        return h
+
+    def join(self, ts: frozenset):
+        """ The most specific common supertype of `ts`, or NOTHING. """
+        if len(ts) == 1:
+            for t in ts:
+                return self.head(t)
+        try:
+            return self.joins[ts]
+        except KeyError:
+            pass
+
+        j = NOTHING
+        origins = {getattr(t, "__origin__", None) for t in ts}
+        arities = {len(t.__args__) for t in ts} if None not in origins else ()
+        if len(origins) == 1 and len(arities) == 1:
+            # join the arguments of the subscripted types position-wise
+            (T,) = origins
+            args = []
+            for col in zip(*[t.__args__ for t in ts]):
+                a = self.join(frozenset(col))
+                if a is NOTHING:
+                    break
+                args.append(a)
+            else:
+                if not self.excluded(T, args):
+                    j = T[tuple(args)]
+
+        if j is NOTHING:  # compare the chains of the plain types
+            chains = [self.chain(t) for t in ts]
+            for t in min(chains, key=len):
+                if all(t in c for c in chains):
+                    j = t
+                    break
+
+        self.joins[ts] = j
+        return j
+
+
 # for testing only
-def get_annotation(values):
+def get_annotation(values, sampling: Optional[Sampling]=None):
     """ Get the type annotation from a list of values. """
-    return get_common_suptype(map(get_type, values), type_map=TYPE_MAP)
+    types = (get_type(v, sampling) for v in values)
+    return get_common_suptype(types, type_map=TYPE_MAP)
+
+
+_full_names = {}  # {id(global_vars): (global_vars, its size, {type: full name})}
+_paths = {}  # {dotted path: the objects along the path}
+
+
+def get_type_name(x) -> str:
+    if x.__module__ == "typing":
+        return getattr(x, "_name", None) or x.__name__  # Any is a class
+    return getattr(x, "__qualname__", x.__name__)
+
+
+def get_path_objects(path: str) -> list:
+    """ The objects along a dotted path from its top-level module, which is
+    imported the first time. """
+    try:
+        return _paths[path]
+    except KeyError:
+        pass
+    names = path.split(".")
+    objs = [import_module(names[0])]
+    for name in names[1:]:
+        objs.append(getattr(objs[-1], name))
+    _paths[path] = objs
+    return objs
 
 
 def get_full_name(x, global_vars: Optional[dict]=None):
     """ Get the full name of a type. `global_vars` is a dict of {object_id: name}.
+
+    The names are cached for each `global_vars` that is given, until its size
+    changes.
     
     Examples:
     >>> import numpy as np
@@ -182,11 +585,6 @@ def get_full_name(x, global_vars: Optional[dict]=None):
     'dict[str, Optional[np.ndarray]]'
     """
 
-    def get_name(x):
-        if x.__module__ == "typing":
-            return x._name
-        return getattr(x, "__qualname__", x.__name__)
-
     if x is Ellipsis:
         return "..."
     if x is None:
@@ -194,12 +592,31 @@ def get_full_name(x, global_vars: Optional[dict]=None):
     if type(x) is str:
         return repr(x)
     if x in REQ_IMPORTS:  # requires importing its module
-        return get_name(x)
+        return get_type_name(x)
     
     if global_vars is None:
         gs = inspect.currentframe().f_back.f_globals.items()
         global_vars = {id(v): k for k, v in gs if k[0] != '_'}
+    elif global_vars:
+        try:
+            _, size, names = _full_names[id(global_vars)]
+            if size != len(global_vars):  # updated
+                raise KeyError
+        except KeyError:
+            names = {}
+            _full_names[id(global_vars)] = (global_vars, len(global_vars), names)
+        try:
+            return names[x]
+        except KeyError:
+            name = names[x] = resolve_full_name(x, global_vars)
+            return name
+        except TypeError:  # unhashable, e.g. a Literal of a list
+            pass
+    return resolve_full_name(x, global_vars)
 
+
+def resolve_full_name(x, global_vars: dict) -> str:
+    """ The uncached `get_full_name`. """
     if id(x) in global_vars:
         return global_vars[id(x)]
     
@@ -217,11 +634,9 @@ def get_full_name(x, global_vars: Optional[dict]=None):
         return x.__name__
     
     # find the module names
-    names = (f"{x.__module__}.{get_name(x)}").split(".")[::-1]
-    mods = [import_module(names[-1])]
-    for name in names[-2::-1]:
-        mods.append(getattr(mods[-1], name))
-    mods = mods[::-1]
+    path = f"{x.__module__}.{get_type_name(x)}"
+    names = path.split(".")[::-1]
+    mods = get_path_objects(path)[::-1]
     
     # find the first module that is imported
     for i, (name, mod) in enumerate(zip(names, mods)):
@@ -246,12 +661,19 @@ def get_full_name(x, global_vars: Optional[dict]=None):
 
 
 def find_defs_in_ast(tree):
-    def recurse(node):  # should be in order
-        if isinstance(node, ast.FunctionDef):
-            yield node
+    """ Find the function definitions in order and set their `qualname`. """
+    def recurse(node, prefix):  # should be in order
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            node.qualname = prefix + node.name
+            if isinstance(node, ast.ClassDef):
+                prefix = node.qualname + "."
+            else:
+                if isinstance(node, ast.FunctionDef):
+                    yield node
+                prefix = node.qualname + ".<locals>."
         for child in ast.iter_child_nodes(node):
-            yield from recurse(child)
-    yield from recurse(tree)
+            yield from recurse(child, prefix)
+    yield from recurse(tree, "")
 
 
 def find_imports_in_ast(tree: ast.Module):
@@ -269,17 +691,60 @@ def get_def_lineno(def_node: ast.FunctionDef):
     return def_node.lineno
 
 
+def get_def_hash(def_node: ast.FunctionDef) -> str:
+    """ A hash of a function definition that does not depend on its position
+    in the file, nor on the annotations of the functions in it, so that it
+    only changes when the code of the function changes. """
+    annotations = []  # [(node, field, value)], removed while dumping the def
+    for n in ast.walk(def_node):
+        if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            A = n.args
+            for a in A.posonlyargs + A.args + A.kwonlyargs + [A.vararg, A.kwarg]:
+                if a is not None:
+                    annotations.append((a, "annotation", a.annotation))
+                    a.annotation = None
+            annotations.append((n, "returns", n.returns))
+            n.returns = None
+    try:
+        dump = ast.dump(def_node)
+    finally:
+        for n, field, value in annotations:
+            setattr(n, field, value)
+    return hashlib.blake2b(dump.encode(), digest_size=8).hexdigest()
+
+
+def get_def_key(def_node: ast.FunctionDef) -> tuple:
+    """ The key (qualname, hash) of the type records of a function. """
+    return def_node.qualname, get_def_hash(def_node)
+
+
+def get_def_keys(tree) -> dict:
+    """ {(lineno, qualname): key} of the functions defined in an ast, which
+    finds the key of the records of a code object from its `co_firstlineno`
+    and `co_qualname` (or `co_name`, which code objects have instead of a
+    qualname before Python 3.11). """
+    keys = {}
+    for node in find_defs_in_ast(tree):
+        lineno = get_def_lineno(node)
+        keys[lineno, node.name] = keys[lineno, node.qualname] = get_def_key(node)
+    return keys
+
+
+def get_source_hash(filepath) -> str:
+    with open(filepath, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
 def annotate_def(def_node: ast.FunctionDef, type_records) -> bool:
     """ Change the annotations of a ast.FunctionDef node in-place.
     Return True if the node is changed. """
 
-    key = (get_def_lineno(def_node), def_node.name)
-    
+    key = get_def_key(def_node)
     if key not in type_records:
         return False  # no type records for this function
-    
+
     records = type_records[key]
-    global_vars = type_records["globals", None]
+    global_vars = type_records.get(("globals", None), {})
     
     A = def_node.args
     all_args = A.posonlyargs + A.args + A.kwonlyargs
@@ -291,8 +756,8 @@ def annotate_def(def_node: ast.FunctionDef, type_records) -> bool:
     
     changed = False
     for a in all_args:
-        if a.annotation or a.arg == "self":
-            continue
+        if a.annotation or a.arg == "self" or not records.get(a.arg):
+            continue  # annotated, or no call has been recorded
         t = union(records[a.arg])
         if a == A.vararg:
             if t is tuple:
@@ -322,7 +787,7 @@ def annotate_def(def_node: ast.FunctionDef, type_records) -> bool:
         a.annotation = ast.Name(anno)
         changed = True
 
-    if def_node.returns is None:
+    if def_node.returns is None and records.get("return"):  # it has returned
         t = union(records["return"])
         anno = get_full_name(t, global_vars)
         def_node.returns = ast.Name(anno)
@@ -334,11 +799,98 @@ def annotate_def(def_node: ast.FunctionDef, type_records) -> bool:
     return changed
 
 
-def annotate_script(filepath, type_records, verbose=False) -> str:
-    """ Output the annotated version of the script at `filepath`. """
+def format_signature(def_node: ast.FunctionDef, indent="") -> str:
+    """ Format the signature of a function (its decorators and def line) by
+    black as the one of a function with an empty body, and indent it. """
+    body, def_node.body = def_node.body, [ast.Pass()]
+    try:
+        mode = black.Mode(line_length=max(black.DEFAULT_LINE_LENGTH - len(indent), 40))
+        lines = black.format_str(ast.unparse(def_node), mode=mode).splitlines()
+    finally:
+        def_node.body = body
+    return "\n".join(indent + line for line in lines[:-1])  # without the body
+
+
+def get_required_imports() -> dict:
+    """ {module: [names]} of REQ_IMPORTS. """
+    required_imports = defaultdict(list)
+    for t in REQ_IMPORTS:
+        mod = t.__module__
+        name = getattr(t, "__name__", getattr(t, "_name", None))
+        required_imports[mod].append(name)
+    return required_imports
+
+
+def get_missing_imports(tree: ast.Module, required_imports, sigs) -> list:
+    """ The import statements of the required imports used in the signatures
+    `sigs` that are not already imported by a module. """
+    imported = defaultdict(set)
+    for imp in find_imports_in_ast(tree):
+        imported[imp.module].update(a.asname or a.name for a in imp.names)
+    sigs = "\n".join(sigs)
+    new_imports = []
+    for mod, names in sorted(required_imports.items()):
+        names = sorted(n for n in names if n not in imported[mod]
+                       and re.search(rf"\b{n}\b", sigs))
+        if names:
+            new_imports.append(f"from {mod} import {', '.join(names)}")
+    return new_imports
+
+
+def count_header_lines(lines) -> int:
+    """ The number of the first lines that must stay first: a shebang and an
+    encoding declaration.
+
+    >>> count_header_lines(["#!/usr/bin/env python", "# -*- coding: utf-8 -*-", "# x"])
+    2
+    >>> count_header_lines(["import os"])
+    0
+    """
+    n = 0
+    while n < min(2, len(lines)) and re.match(r"#!|#.*coding[:=]", lines[n]):
+        n += 1
+    return n
+
+
+def insert_imports(lines, tree: ast.Module, required_imports, sigs):
+    """ Insert the required imports used in the signatures `sigs` that are not
+    already imported at the end of the import block at the top of a module.
+    """
+    pos, has_imports = 0, False
+    for i, node in enumerate(tree.body):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            has_imports = True
+        elif not (i == 0 and isinstance(node, ast.Expr)
+                  and isinstance(node.value, ast.Constant)):  # docstring
+            break
+        pos = node.end_lineno
+    pos = max(pos, count_header_lines(lines))
+    new_imports = get_missing_imports(tree, required_imports, sigs)
+    if new_imports and not has_imports:
+        new_imports.append("")
+    lines[pos:pos] = new_imports
+
+
+def annotate_script(filepath, type_records, verbose=False, only_signatures=False) -> str:
+    """ Output the annotated version of the script at `filepath`. The whole
+    script is formatted by isort and black, or only the new signatures if
+    `only_signatures`, which also only adds the imports that they use.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "m.py")
+    >>> write_script(path, "#!/usr/bin/env python\\ndef f(x): return x  # same line\\n")
+    >>> key = get_def_key(next(find_defs_in_ast(ast.parse(open(path).read()))))
+    >>> records = {key: {"x": {int: 1, None: 1}, "return": {int: 1}}}
+    >>> print(annotate_script(path, records, only_signatures=True), end="")
+    #!/usr/bin/env python
+    from typing import Optional
+    <BLANKLINE>
+    def f(x: Optional[int]) -> int: return x  # same line
+    """
     
     s = open(filepath, encoding="utf8").read()
     lines = s.splitlines()
+    eol = "\n" if s.endswith("\n") else ""
     tree = ast.parse(s)
     
     # annotate function definitions in-place and find the changed ones
@@ -349,11 +901,7 @@ def annotate_script(filepath, type_records, verbose=False) -> str:
         return None
     
     # find all required imports
-    required_imports = defaultdict(list)
-    for t in REQ_IMPORTS:
-        mod = t.__module__
-        name = getattr(t, "__name__", getattr(t, "_name", None))
-        required_imports[mod].append(name)
+    required_imports = get_required_imports()
     
     # # find all imports in the script
     # imps = list(find_imports_in_ast(tree))
@@ -374,11 +922,21 @@ def annotate_script(filepath, type_records, verbose=False) -> str:
     starts, ends, sigs = [], [], []
     for node in defs:
         ln0, ln1 = get_def_lineno(node), node.body[0].lineno
+        # a body on the line of the colon, e.g. `def f(x): return x`, is kept
+        # after the new signature
+        col = node.body[0].col_offset
+        same_line = lines[ln1 - 1][:col].strip() != ""
+        tail = lines[ln1 - 1][col:] if same_line else None
         starts.append(ln0 - 1)
-        ends.append(ln1 - 1)
+        ends.append(ln1 if same_line else ln1 - 1)
         node.body = []  # only keep signature
         indent = re.match(r"\s*", lines[ln0 - 1])[0]
-        line = indent + ast.unparse(node).replace("\n", "\n" + indent)
+        if only_signatures:
+            line = format_signature(node, indent)
+        else:
+            line = indent + ast.unparse(node).replace("\n", "\n" + indent)
+        if tail is not None:
+            line += " " + tail
         sigs.append(line)
         if verbose:
             print("Old:", *lines[ln0 - 1 : ln1 - 1], sep="\n")
@@ -393,9 +951,16 @@ def annotate_script(filepath, type_records, verbose=False) -> str:
         if sig is not None:
             new_lines.append(sig)
 
+    if only_signatures:
+        insert_imports(new_lines, tree, required_imports, sigs)
+        new_script = "\n".join(new_lines) + eol
+        ast.parse(new_script, filepath)  # not formatted by black, which checks it
+        return new_script
+
     # insert missing imports
+    pos = count_header_lines(new_lines)
     for mod, names in required_imports.items():
-        new_lines.insert(0, f"from {mod} import {', '.join(names)}")
+        new_lines.insert(pos, f"from {mod} import {', '.join(names)}")
 
     # reformat new script
     new_script = "\n".join(new_lines)
@@ -404,6 +969,228 @@ def annotate_script(filepath, type_records, verbose=False) -> str:
     return new_script
 
 
+def get_stub(tree: ast.Module, type_records) -> str:
+    """ The stub (.pyi) of a module: its imports, and its classes and functions
+    with the signatures annotated from `type_records`. The stub is made in a
+    single pass over the statements of the module and is not formatted.
+
+    >>> tree = ast.parse(
+    ...     "import numpy as np\\n"
+    ...     "X = 1\\n"
+    ...     "class A:\\n"
+    ...     "    n: int = 0\\n"
+    ...     "    def f(self, x, y=0, *args):\\n"
+    ...     "        return [x]\\n"
+    ...     "def g(z) -> int:\\n"
+    ...     "    return len(z)\\n")
+    >>> key = get_def_key(next(find_defs_in_ast(tree)))
+    >>> records = {key: {"x": {int: 1}, "y": {int: 1},
+    ...                  "args": {tuple: 1}, "return": {list[int]: 1}}}
+    >>> print(get_stub(tree, records), end="")
+    from typing import Any
+    import numpy as np
+    X: Any
+    class A:
+        n: int
+        def f(self, x: int, y: int=..., *args: Any) -> list[int]: ...
+    def g(z) -> int: ...
+
+    The names assigned are declared as Any, and the statements under `if` and
+    `try` are included, without declaring a name again:
+
+    >>> print(get_stub(ast.parse(
+    ...     "try:\\n"
+    ...     "    import ujson as json\\n"
+    ...     "except ImportError:\\n"
+    ...     "    json = None\\n"
+    ...     "if json:\\n"
+    ...     "    def load(s): ...\\n"
+    ...     "else:\\n"
+    ...     "    a, b = 1, 2\\n"), {}), end="")
+    from typing import Any
+    import ujson as json
+    def load(s): ...
+    a: Any
+    b: Any
+
+    The imports are added after the __future__ imports:
+
+    >>> tree = ast.parse("from __future__ import annotations\\ndef h(s): pass\\n")
+    >>> key = get_def_key(next(find_defs_in_ast(tree)))
+    >>> print(get_stub(tree, {key: {"s": {str: 1}, "return": {Any: 1}}}), end="")
+    from __future__ import annotations
+    from typing import Any
+    def h(s: str) -> Any: ...
+    """
+
+    lines, sigs = [], []
+
+    def visit(node, prefix, indent, names):
+        # `names`: the names already in the stub of the module or class, which
+        # are not declared again by the assignments of other branches
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            lines.append(indent + ast.unparse(node))
+            names.update((a.asname or a.name).split(".")[0] for a in node.names)
+        elif isinstance(node, ast.If) and ast.unparse(node.test) == "__name__ == '__main__'":
+            pass  # the script part of the module
+        elif isinstance(node, (ast.If, ast.Try)):  # e.g. optional imports
+            handlers = [c for h in getattr(node, "handlers", ()) for c in h.body]
+            for child in node.body + handlers + node.orelse + getattr(node, "finalbody", []):
+                visit(child, prefix, indent, names)
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            lines.append(f"{indent}{node.target.id}: {ast.unparse(node.annotation)}")
+            names.add(node.target.id)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                for n in ast.walk(target):  # a name, or the names unpacked
+                    if (isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)
+                            and n.id not in names):
+                        line = f"{n.id}: Any"
+                        sigs.append(line)
+                        lines.append(indent + line)
+                        names.add(n.id)
+        elif isinstance(node, ast.ClassDef):
+            node.qualname = prefix + node.name
+            body, node.body = node.body, []
+            lines.extend(indent + line for line in ast.unparse(node).splitlines())
+            names.add(node.name)
+            start, class_names = len(lines), set()
+            for child in body:
+                visit(child, node.qualname + ".", indent + "    ", class_names)
+            if len(lines) == start:
+                lines[-1] += " ..."
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            node.qualname = prefix + node.name
+            if isinstance(node, ast.FunctionDef):
+                annotate_def(node, type_records)
+            A = node.args
+            A.defaults = [ast.Constant(...) for _ in A.defaults]
+            A.kw_defaults = [d and ast.Constant(...) for d in A.kw_defaults]
+            node.body = []
+            sig = ast.unparse(node) + " ..."
+            sigs.append(sig)
+            lines.extend(indent + line for line in sig.splitlines())
+            names.add(node.name)
+
+    module_names = set()
+    for node in tree.body:
+        visit(node, "", "", module_names)
+
+    pos = 0
+    while pos < len(lines) and lines[pos].startswith("from __future__ "):
+        pos += 1
+    lines[pos:pos] = get_missing_imports(tree, get_required_imports(), sigs)
+    return "\n".join(lines) + "\n"
+
+
+def make_stub(filepath, type_records) -> str:
+    """ Output the stub (.pyi) of the module at `filepath`. """
+    with open(filepath, encoding="utf8") as f:
+        return get_stub(ast.parse(f.read()), type_records)
+
+
+def get_stub_path(filepath) -> str:
+    return os.path.splitext(filepath)[0] + ".pyi"
+
+
+def read_file(filepath) -> Optional[str]:
+    """ The content of a file, or None if it does not exist. """
+    try:
+        with open(filepath, encoding="utf8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_script(filepath, s: str):
+    """ Replace a script atomically, keeping its permissions. """
+    tmp = filepath + ".anno.tmp"
+    with open(tmp, "w", encoding="utf8") as f:
+        f.write(s)
+    if os.path.exists(filepath):
+        shutil.copymode(filepath, tmp)
+    os.replace(tmp, filepath)
+
+
+def get_records_state(recs) -> list:
+    """ The functions of the records of a file with the slots that have types,
+    which decide what the annotation of the file adds.
+
+    >>> recs = {("f", "h"): {"x": {int: 1}, "return": {}}, ("globals", None): {}}
+    >>> get_records_state(recs)
+    ['f h x']
+    >>> recs["f", "h"]["return"][int] = 1  # a call has returned
+    >>> get_records_state(recs)
+    ['f h return,x']
+    >>> recs["g", "k"] = {"y": {str: 1}}
+    >>> get_records_state(recs)
+    ['f h return,x', 'g k y']
+    """
+    return sorted(
+        f"{key[0]} {key[1]} " + ",".join(sorted(k for k, c in rec.items()
+                                               if isinstance(k, str) and c))
+        for key, rec in recs.items() if key != ("globals", None)
+    )
+
+
+_annotating = None  # (type_records, format, verbose) of the running annotate_files
+
+
+def annotate_file(filepath):
+    """ Annotate a file (or make its stub) in memory for `annotate_files`,
+    returning also what has been printed. """
+    type_records, format, verbose = _annotating
+    if format == "stubs":
+        return make_stub(filepath, type_records[filepath]), ""
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        s = annotate_script(filepath, type_records[filepath], verbose,
+                            format == "signatures")
+    return s, out.getvalue()
+
+
+def annotate_files(type_records, annotated: dict, format="file", verbose=False,
+                   jobs=1, write=write_script) -> list:
+    """ Annotate the files of `type_records`, or write their stubs if `format`
+    is "stubs" (see `--format`), and return the paths of the written files.
+
+    `annotated` ({written path: [source hash, records state]}) is updated,
+    and the files annotated with records of the same slots of the same
+    functions and unchanged since are skipped, but the stubs are always
+    remade. A file is only written if it changes, by `write(path, s)`, which
+    returns False if it does not write it. With `jobs` > 1, the files are annotated by forked processes, which
+    share the records and the ids in their globals indices. """
+    global _annotating
+    todo = {}  # {filepath: (written path, state)}
+    for path, recs in type_records.items():
+        state = [get_source_hash(path), get_records_state(recs)]
+        target = get_stub_path(path) if format == "stubs" else path
+        # a stub is made from all the types of the records, which can change
+        # without changing the state, but is cheap to remake
+        if (format == "stubs" or annotated.get(target) != state
+                or not os.path.exists(target)):
+            todo[path] = target, state
+
+    _annotating = type_records, format, verbose
+    try:
+        if jobs > 1 and len(todo) > 1:  # all the results come before any write
+            with multiprocessing.get_context("fork").Pool(min(jobs, len(todo))) as pool:
+                results = pool.map(annotate_file, todo, chunksize=1)
+        else:
+            results = map(annotate_file, todo)
+        written = []
+        for (path, (target, state)), (s, out) in zip(todo.items(), results):
+            print(out, end="")
+            if s is None or s == read_file(target):
+                annotated[target] = state
+            elif write(target, s) is not False:
+                annotated[target] = [get_source_hash(path), state[1]]
+                written.append(target)
+    finally:
+        _annotating = None
+    return written
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
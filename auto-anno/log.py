@@ -0,0 +1,321 @@
+""" An append-only log of type records.
+
+A log is a directory of shards, each written by a single thread of a single
+process, so that no locks or merges are needed while collecting. A shard is a
+sequence of frames:
+
+    kind (1 byte) | ident (4 bytes) | name length (4 bytes) | data length (4 bytes) | name | data
+
+- TYPE frames intern a type: `ident` is its id in the shard and `data` is the
+  type pickled by cloudpickle.
+- RECS frames add type counts to the records of the file `name`: `data` is a
+  pickled list of (key, argname, [(type id, count), ...]).
+
+A shard only grows by whole frames, which are flushed together, so a crash
+loses at most the last flush and a torn frame at the end is ignored. Since the
+records are keyed by file in the frame headers, the records of a file can be
+read without unpickling the rest, and the types are only unpickled when a
+record refers to them.
+
+Usage: python -m auto-anno.log {show,compact,merge} LOG [...]
+"""
+
+# stdlib
+import os
+import sys
+import json
+import pickle
+import struct
+import secrets
+import argparse
+import threading
+from collections import Counter
+
+# third party
+import cloudpickle
+
+
+TYPE, RECS = 1, 2
+HEADER = struct.Struct("<BIII")
+SUFFIX = ".log"
+ANNOTATED = "annotated.json"  # {filename: [source hash, record keys]} of the last annotation
+STATS = "stats"  # the .txt and .json report of the statistics of the last collection
+
+
+class Pickled(bytes):
+    """ A type kept pickled, so that logs can be compacted without importing
+    the modules of their types. """
+
+
+class Shard:
+    """ The writer of a shard of the log `path`, which appends the counts
+    that the records have gained since the last write. `baseline` is the
+    records whose counts are already in the log. The file is only created
+    when there is something to write. """
+
+    def __init__(self, path, baseline=None):
+        self.path = path
+        self.file = None
+        self.types = {}  # {type: its id in the shard}
+        self.written = {}  # {(filename, key, argname): Counter of the log}
+        self.lock = threading.Lock()  # writes of a periodic flush and of stop
+        if baseline:
+            for _ in self.diff(baseline):
+                pass
+
+    def open(self):
+        name = f"{os.getpid()}-{threading.get_ident()}-{secrets.token_hex(4)}"
+        self.file = open(os.path.join(self.path, name + SUFFIX), "xb")
+
+    def intern(self, t, frames) -> int:
+        try:
+            return self.types[t]
+        except KeyError:
+            i = self.types[t] = len(self.types)
+            data = t if isinstance(t, Pickled) else cloudpickle.dumps(t)
+            frames.append(frame(TYPE, i, "", data))
+            return i
+
+    def diff(self, records):
+        """ Yield (filename, [(key, argname, [(type, count), ...]), ...]) of
+        the counts that `records` have gained since the last diff. """
+        for filename, recs in list(records.items()):
+            rows = []
+            for key, rec in list(recs.items()):
+                if key == ("globals", None):
+                    continue
+                for k, counts in list(rec.items()):
+                    try:
+                        written = self.written[filename, key, k]
+                    except KeyError:
+                        written = self.written[filename, key, k] = Counter()
+                    new = [(t, n - written[t]) for t, n in list(counts.items())
+                           if n > written[t]]
+                    if new:
+                        written.update(dict(new))
+                        rows.append((key, k, new))
+            if rows:
+                yield filename, rows
+
+    def write(self, records):
+        """ Append the new counts of `records` to the shard.
+
+        >>> import tempfile
+        >>> log = tempfile.TemporaryDirectory()
+        >>> records = {"a.py": {("f", "h"): {"x": Counter({int: 2})}}}
+        >>> shard = Shard(log.name)
+        >>> shard.write(records)
+        >>> read_log(log.name)
+        {'a.py': {('f', 'h'): {'x': Counter({<class 'int'>: 2})}}}
+
+        A second write only appends the counts gained since the first:
+        >>> records["a.py"]["f", "h"]["x"].update([int, str])
+        >>> shard.write(records)
+        >>> shard.close()
+        >>> read_log(log.name)
+        {'a.py': {('f', 'h'): {'x': Counter({<class 'int'>: 3, <class 'str'>: 1})}}}
+        """
+        with self.lock:
+            frames = []
+            for filename, rows in self.diff(records):
+                rows = [(key, k, [(self.intern(t, frames), n) for t, n in new])
+                        for key, k, new in rows]
+                frames.append(frame(RECS, 0, filename, pickle.dumps(rows)))
+            if not frames:
+                return
+            if self.file is None:
+                self.open()
+            self.file.write(b"".join(frames))
+            self.file.flush()
+
+    def close(self):
+        """ Close the file of the shard. A later write appends the new counts
+        to a new shard. """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def frame(kind, ident, name: str, data: bytes) -> bytes:
+    name = name.encode()
+    return HEADER.pack(kind, ident, len(name), len(data)) + name + data
+
+
+def iter_frames(path, filename=None):
+    """ Yield the frames (kind, ident, name, data) of a shard, skipping the
+    data of the RECS frames of other files than `filename` if it is given.
+
+    A torn frame at the end of the shard is skipped:
+    >>> import tempfile
+    >>> log = tempfile.TemporaryDirectory()
+    >>> shard = Shard(log.name)
+    >>> shard.write({"a.py": {("f", None): {"x": Counter({int: 1})}}})
+    >>> shard.close()
+    >>> path = get_shards(log.name)[0]
+    >>> with open(path, "ab") as f:
+    ...     _ = f.write(frame(RECS, 0, "b.py", b"data")[:-1])
+    >>> [(kind, name) for kind, _, name, _ in iter_frames(path)]
+    [(1, ''), (2, 'a.py')]
+    >>> read_log(log.name)
+    {'a.py': {('f', None): {'x': Counter({<class 'int'>: 1})}}}
+    """
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            kind, ident, name_len, data_len = HEADER.unpack(header)
+            name = f.read(name_len)
+            if len(name) < name_len:  # torn by a crash
+                return
+            name = name.decode()
+            if kind == RECS and filename is not None and name != filename:
+                f.seek(data_len, 1)
+                continue
+            data = f.read(data_len)
+            if len(data) < data_len:  # torn by a crash
+                return
+            yield kind, ident, name, data
+
+
+def get_shards(path) -> list:
+    """ The shards of a log, in a deterministic order. """
+    if not os.path.isdir(path):
+        return []
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if name.endswith(SUFFIX)]
+
+
+def read_shard(path, records, filename=None, load=cloudpickle.loads):
+    """ Add the counts of a shard to `records`, or only the ones of the file
+    `filename`. The types are unpickled by `load`. """
+    pickled, types = {}, {}
+    for kind, ident, name, data in iter_frames(path, filename):
+        if kind == TYPE:
+            pickled[ident] = data
+            continue
+        recs = records.setdefault(name, {})
+        for key, k, counts in pickle.loads(data):
+            rec = recs.setdefault(key, {})
+            c = rec.get(k)
+            if c is None:
+                c = rec[k] = Counter()
+            for i, n in counts:
+                try:
+                    t = types[i]
+                except KeyError:
+                    t = types[i] = load(pickled[i])
+                c[t] += n
+
+
+def read_log(path, filename=None) -> dict:
+    """ The records {filename: {key: {argname: Counter}}} of a log, or only
+    the ones of the file `filename`.
+
+    >>> import tempfile
+    >>> log = tempfile.TemporaryDirectory()
+    >>> shard = Shard(log.name)
+    >>> shard.write({"a.py": {("f", None): {"x": Counter({int: 1})}},
+    ...              "b.py": {("g", None): {"return": Counter({str: 1})}}})
+    >>> shard.close()
+    >>> sorted(read_log(log.name))
+    ['a.py', 'b.py']
+    >>> read_log(log.name, "b.py")
+    {'b.py': {('g', None): {'return': Counter({<class 'str'>: 1})}}}
+    """
+    records = {}
+    for shard in get_shards(path):
+        read_shard(shard, records, filename)
+    return records
+
+
+def read_annotated(path) -> dict:
+    try:
+        with open(os.path.join(path, ANNOTATED)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_annotated(path, annotated: dict):
+    os.makedirs(path, exist_ok=True)
+    tmp = os.path.join(path, ANNOTATED + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(annotated, f, indent=1)
+    os.replace(tmp, os.path.join(path, ANNOTATED))
+
+
+def compact(path, *sources, prune=None):
+    """ Rewrite the log `path` and the logs `sources` as a single shard of
+    `path`, without the records that `prune(records)` removes if it is given.
+    The logs must not be written while they are compacted.
+
+    >>> import tempfile
+    >>> a, b = tempfile.TemporaryDirectory(), tempfile.TemporaryDirectory()
+    >>> for log, n in ((a, 1), (a, 2), (b, 4)):
+    ...     shard = Shard(log.name)
+    ...     shard.write({"a.py": {("f", None): {"x": Counter({int: n})}}})
+    ...     shard.close()
+    >>> compact(a.name)
+    >>> len(get_shards(a.name)), read_log(a.name)
+    (1, {'a.py': {('f', None): {'x': Counter({<class 'int'>: 3})}}})
+    >>> compact(a.name, b.name)  # merge
+    >>> len(get_shards(a.name)), get_shards(b.name), read_log(a.name)
+    (1, [], {'a.py': {('f', None): {'x': Counter({<class 'int'>: 7})}}})
+    >>> compact(a.name, prune=lambda records: records.pop("a.py"))
+    >>> read_log(a.name)
+    {}
+    """
+    records, shards = {}, []
+    for p in (path, *sources):
+        for shard in get_shards(p):
+            read_shard(shard, records, load=Pickled)
+            shards.append(shard)
+    if prune is not None:
+        prune(records)
+    os.makedirs(path, exist_ok=True)
+    tmp = os.path.join(path, "compact.tmp")
+    writer = Shard(path)
+    writer.file = open(tmp, "wb")
+    writer.write(records)
+    writer.close()
+    os.replace(tmp, os.path.join(path, f"0-compact-{secrets.token_hex(4)}{SUFFIX}"))
+    for shard in shards:
+        os.remove(shard)
+
+
+def show(path, filename=None, file=sys.stdout):
+    for name, recs in read_log(path, filename and os.path.abspath(filename)).items():
+        print(name, file=file)
+        for key, rec in sorted(recs.items(), key=lambda kv: repr(kv[0])):
+            print(f"  {key[0]} {key[1]}", file=file)
+            for k, counts in rec.items():
+                types = ", ".join(f"{t}: {n}" for t, n in counts.most_common())
+                print(f"    {k}: {types}", file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m auto-anno.log")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("show", help="print the records of a log")
+    p.add_argument("log")
+    p.add_argument("file", nargs="?", help="only print the records of this file")
+    p = commands.add_parser("compact", help="rewrite a log as a single shard")
+    p.add_argument("log")
+    p = commands.add_parser(
+        "merge", help="move the records of other logs into a log and compact it"
+    )
+    p.add_argument("log")
+    p.add_argument("sources", nargs="+")
+    args = parser.parse_args(argv)
+    if args.command == "show":
+        show(args.log, args.file)
+    elif args.command == "compact":
+        compact(args.log)
+    else:
+        compact(args.log, *args.sources)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+""" A pytest plugin that collects the types of the functions called by the tests.
+
+Usage: pytest -p auto-anno.pytest_plugin --anno [--anno-annotate] [-n WORKERS]
+
+The functions defined under the rootdir (or --anno-cwd) are traced while the
+tests run, except the ones of the test modules and conftest files. Every
+process appends its records to its own shards of the log --anno-log, so the
+workers of pytest-xdist collect in parallel, and their shards are merged when
+the log is read. With --anno-annotate, the process that started the session
+(the controller of the xdist workers) annotates the files from the whole log
+at the end, as `python -m auto-anno --log LOG` does.
+"""
+
+# stdlib
+import os
+import sys
+
+# third party
+import pytest
+
+# local
+from .lib import *
+from . import collect, log
+
+
+ANNOTATED = pytest.StashKey[list]()  # the paths of the files annotated by the session
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("auto-anno", "collect the types of the tested functions")
+    group.addoption(
+        "--anno",
+        action="store_true",
+        help="collect the types of the functions called by the tests",
+    )
+    group.addoption(
+        "--anno-log",
+        default="type_records.log",
+        help="the directory of the log of type records, relative to the rootdir",
+    )
+    group.addoption(
+        "--anno-cwd",
+        default=None,
+        help="only trace the functions defined under this directory (the "
+        "rootdir by default)",
+    )
+    group.addoption(
+        "--anno-backend",
+        choices=("auto",) + collect.BACKENDS,
+        default="auto",
+        help="how to collect the types, as --backend of auto-anno",
+    )
+    group.addoption(
+        "--anno-rate",
+        type=float,
+        default=None,
+        help="only record this fraction of the calls, chosen at random",
+    )
+    group.addoption(
+        "--anno-annotate",
+        action="store_true",
+        help="annotate the files from the log at the end of the session",
+    )
+    group.addoption(
+        "--anno-format",
+        choices=("file", "signatures", "stubs"),
+        default="file",
+        help="how to format the annotated files, as --format of auto-anno",
+    )
+
+
+def is_worker(config) -> bool:
+    return hasattr(config, "workerinput")
+
+
+def is_controller(config) -> bool:
+    """ Whether this process only controls xdist workers and runs no tests. """
+    return not is_worker(config) and getattr(config.option, "dist", "no") != "no"
+
+
+def pytest_configure(config):
+    if not config.getoption("anno"):
+        return
+    root = str(config.rootpath)
+    collect.CWD = os.path.abspath(config.getoption("anno_cwd") or root)
+    collect.LOG = os.path.join(root, config.getoption("anno_log"))
+    collect.FLUSH = 10
+    collect.RATE = config.getoption("anno_rate")
+
+
+def pytest_collection_finish(session):
+    config = session.config
+    if not config.getoption("anno") or is_controller(config):
+        return
+    collect.EXCLUDE.update(str(item.path) for item in session.items)
+    for plugin in config.pluginmanager.get_plugins():
+        filename = getattr(plugin, "__file__", None) or ""
+        if os.path.basename(filename) == "conftest.py":
+            collect.EXCLUDE.add(os.path.abspath(filename))
+    collect.start(config.getoption("anno_backend"))
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_sessionfinish(session):
+    config = session.config
+    if not config.getoption("anno"):
+        return
+    collect.stop()  # appends the records of this process to the log
+    if config.getoption("anno_annotate") and not is_worker(config):
+        config.stash[ANNOTATED] = annotate(config)
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    paths = config.stash.get(ANNOTATED, None)
+    if paths:
+        terminalreporter.write_sep("-", "auto-anno")
+        for path in paths:
+            terminalreporter.write_line(f"annotated {path}")
+
+
+def annotate(config) -> list:
+    """ Annotate the files from the records of the whole log, returning the
+    paths of the changed files. """
+    # the modules of the log are imported to unpickle their types and index
+    # their imports, even by an xdist controller, which collects no tests
+    if collect.CWD not in sys.path:
+        sys.path.append(collect.CWD)
+    records = log.read_log(collect.LOG)
+    collect.prune_records(records)
+    for filename, recs in records.items():  # the globals indices of this process
+        index = collect.TYPE_RECS.get(filename, {}).get(("globals", None))
+        if index is not None:
+            recs["globals", None] = index
+    collect.TYPE_RECS = records
+    collect.index_modules()  # the modules not traced here, e.g. by xdist workers
+
+    annotated = log.read_annotated(collect.LOG)
+    changed = annotate_files(records, annotated, config.getoption("anno_format"),
+                             config.getoption("verbose") > 0)
+    log.write_annotated(collect.LOG, annotated)
+    return changed